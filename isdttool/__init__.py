@@ -6,16 +6,37 @@ reverse engineered using a ISDT C4, and a A4 charger. I assume that the measurem
 out wrong for other models, but it should be easy to adopt. There are things in the protocol which
 I didn't understand. You're welcome to help. A C4evo charger is already ordered."""
 
-from .charger.charger import get_device, Charger
+import sys
+from types import ModuleType
 
-DEBUG_MODE = False
+from .charger import charger as _charger_module
+from .charger.charger import get_device, Charger
 
 __all__ = ['get_device', 'Charger']
 
 
+class _Package(ModuleType):
+    """The debug flag moved to the charger module, where it's checked for every frame. This keeps
+    reading, and assigning isdttool.DEBUG_MODE working anyway."""
+
+    # noinspection PyPep8Naming
+    @property
+    def DEBUG_MODE(self) -> bool:
+        """Alias of the flag in the charger module, see set_debug."""
+        return _charger_module.DEBUG_MODE
+
+    # noinspection PyPep8Naming
+    @DEBUG_MODE.setter
+    def DEBUG_MODE(self, enabled: bool) -> None:
+        _charger_module.DEBUG_MODE = enabled
+
+
+sys.modules[__name__].__class__ = _Package
+
+
 def set_debug(enabled: bool) -> None:
-    """Enables or disables the protocol debug mode
+    """Enables or disables the protocol debug mode. Assigning isdttool.DEBUG_MODE does the same,
+    it's kept for compatibility.
 
     :param enabled: Knob direction"""
-    global DEBUG_MODE
-    DEBUG_MODE = enabled
+    _charger_module.DEBUG_MODE = enabled
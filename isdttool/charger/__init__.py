@@ -6,8 +6,9 @@ the commands."""
 from .actions import display_link_test, write_raw_command, reboot_to_boot_loader, \
     display_version, display_metrics, verify_firmware, rename_device, reboot_to_app, \
     display_sensors, read_serial_number, monitor_state
-from .charger import Charger
+from .charger import Charger, AsyncCharger
 
-__all__ = ['Charger', 'display_link_test', 'write_raw_command', 'reboot_to_boot_loader',
-           'display_metrics', 'display_version', 'verify_firmware', 'rename_device',
-           'reboot_to_app', 'display_sensors', 'read_serial_number', 'monitor_state']
+__all__ = ['Charger', 'AsyncCharger', 'display_link_test', 'write_raw_command',
+           'reboot_to_boot_loader', 'display_metrics', 'display_version', 'verify_firmware',
+           'rename_device', 'reboot_to_app', 'display_sensors', 'read_serial_number',
+           'monitor_state']
@@ -4,45 +4,69 @@
 import csv
 import json
 import sys
-from io import BytesIO
+from functools import lru_cache
+from threading import Event
 from time import sleep
-from typing import BinaryIO, Dict, List, Optional, Union, Tuple, Callable
+from typing import AbstractSet, BinaryIO, Dict, List, Optional, Union, Tuple, Callable, \
+    Iterable
 
 import isdttool
 from .charger import Charger
 from .representation import packet_to_str, parse_packet
-from ..firmware import decrypt_firmware_image
 
+# Fields of the metrics packet whose changes are reported by monitor_state.
+WATCHED_KEYS: Tuple[str, ...] = ('mode id', 'chemistry id', 'dimensions id')
 
-class RedirectWriteToPrint:
-    """The csv.DictWriter seems to have some serious quirks when using it to write to stdout.
-    E.g. redirection works, piping does not. So here you go. It's just a wrapper around print
-    with some minor adjustments to the parameters. """
-    @staticmethod
-    def write(*args, **kwargs) -> None:
-        """This is an implementation of the Python file protocol just enough to use it with
-        csv.DictWriter. """
-        kwargs['flush'] = True
-        kwargs['end'] = ''
-        print(*args, **kwargs)
+# The (model, mode) configurations each command is known to work with.
+_ANY_MODE = frozenset({('C4', 'app'), ('A4', 'app'), ('C4EVO', 'app'),
+                       ('C4', 'boot loader'), ('A4', 'boot loader'), ('C4EVO', 'boot loader')})
+_BOOT_LOADER = frozenset({('C4', 'boot loader'), ('A4', 'boot loader'), ('C4EVO', 'boot loader')})
+_RENAME = frozenset({('C4', 'app'), ('Q8', 'app')})
+_SERIAL_NUMBER = frozenset({('C4', 'app'), ('A4', 'app')})
+_METRICS = frozenset({('C4', 'app'), ('A4', 'app'), ('C4EVO', 'app')})
+_SENSORS = frozenset({('C4', 'app')})
+_CHANNEL_SENSORS = frozenset({('C4EVO', 'app')})
+_CHANNEL_VOLTAGES = frozenset({('Q8', 'app')})
 
+# Channels requested by one metrics_batch. Any more, and the responses might not fit into the
+# input report queue of hidapi.
+_METRICS_BATCH_SIZE = 4
 
-def assure_compatibility(charger: Charger, configurations: List[Tuple[str, str]]) -> bool:
+
+@lru_cache(maxsize=256)
+def __parse_cached__(packet: bytes, model: Optional[str]) -> Dict[str, Union[str, int, bool]]:
+    """
+    Parses a packet, and remembers the result. Successive metrics packets of an idle channel are
+    byte-identical, so this saves parsing them over and over again. The returned dict is shared
+    between callers, so copy it before modifying it.
+    :param packet: The payload as retrieved by read_packet, converted to bytes to be hashable.
+    :param model: See parse_packet.
+    :return: The same as parse_packet.
+    """
+    return parse_packet(packet, model)
+
+
+def assure_compatibility(charger: Charger, configurations: AbstractSet[Tuple[str, str]]) -> bool:
     """
     This ensures compatibility, and provides a proper error message if a command is not supported.
     If debug_mode is True, this skips the check, and always returns True.
     :param charger: The charger to test.
-    :param configurations: A list of tuples like [('A4', 'boot'), ('C4', 'app')]
+    :param configurations: A set of tuples like {('A4', 'boot'), ('C4', 'app')}
     :return: True, if charger matches.
     """
-    for model, mode in configurations:
-        if charger.model in (model, 'ignore') and charger.mode in (mode, 'ignore'):
-            return True
+    if (charger.model, charger.mode) in configurations:
+        return True
+
+    # Only when the user chose to ignore the model or mode the configurations have to be scanned.
+    if 'ignore' in (charger.model, charger.mode):
+        for model, mode in configurations:
+            if charger.model in (model, 'ignore') and charger.mode in (mode, 'ignore'):
+                return True
 
     print('This command is currently not supported by the model "{}" in {} mode.\n'
           'The command is supported in the following modes:'.format(charger.model, charger.mode),
           file=sys.stderr)
-    for i in configurations:
+    for i in sorted(configurations):
         print('Model "{}" in {} mode'.format(i[0], i[1]), file=sys.stderr)
 
     return False
@@ -59,19 +83,23 @@ def print_simple_result(charger: Charger, output_mode: str = 'text') -> None:
         print('Charger returned no result.', file=sys.stderr)
         return
     else:
+        if output_mode != 'raw':
+            parsed = __parse_cached__(bytes(result), charger.model)
+
         if output_mode == 'text':
-            print(packet_to_str(result, charger.model))
+            print(packet_to_str(parsed, charger.model))
         elif output_mode == 'dict':
-            print(parse_packet(result, charger.model))
-        elif output_mode == 'json':
-            print(json.dumps(parse_packet(result, charger.model)))
+            print(parsed)
+        elif output_mode in ('json', 'ndjson'):
+            # A single result is the same in both.
+            print(json.dumps(parsed))
         elif output_mode == 'csv':
-            result = parse_packet(result, charger.model)
-            writer = csv.DictWriter(RedirectWriteToPrint(), result.keys())
+            writer = csv.DictWriter(sys.stdout, parsed.keys())
             writer.writeheader()
-            writer.writerow(result)
+            writer.writerow(parsed)
+            sys.stdout.flush()
         elif output_mode == 'raw':
-            print(' '.join(f'{x:02x}' for x in result))
+            print(result.hex(' '))
         else:
             raise ValueError('Output mode "{}" is not implemented.'.format(output_mode))
 
@@ -96,7 +124,7 @@ def rename_device(charger: Charger, name: str = '', output_mode: str = 'text') -
     with care.
     :param output_mode: Either csv, test, json, or dict.
     """
-    if not assure_compatibility(charger, [('C4', 'app'), ('Q8', 'app')]):
+    if not assure_compatibility(charger, _RENAME):
         return
 
     charger.rename_device(name)
@@ -110,7 +138,7 @@ def read_serial_number(charger: Charger, output_mode='text') -> None:
     :param charger: An usb.Device object for the charger as retrieved by isdttool.get_device
     :param output_mode: Either csv, test, json, or dict.
     """
-    if not assure_compatibility(charger, [('C4', 'app'), ('A4', 'app')]):
+    if not assure_compatibility(charger, _SERIAL_NUMBER):
         return
 
     charger.get_mcu_serial_number()
@@ -120,47 +148,86 @@ def read_serial_number(charger: Charger, output_mode='text') -> None:
 def display_metrics(charger: Charger, interval: float, count: int, channels: List[int],
                     output_mode='text') -> None:
     """
-       Queries the state of the charging channel.
+       Queries the state of the charging channel. The request for the next channel is written
+       before the response to the current one is read, so this relies on the charger answering
+       in order, which all tested models do.
        :param charger: An usb.Device object for the charger as retrieved by isdttool.get_device
        :param interval: How many seconds to wait between queries.
        :param count: Stop after that many queries.
        :param channels: List of the zero-indexed channel numbers to query.
-       :param output_mode: Either csv, test, json, or dict.
+       :param output_mode: Either csv, test, json, ndjson, or dict. ndjson prints one object per
+       line as soon as it was read, json collects everything, and prints a list when done.
     """
-    if not assure_compatibility(charger, [('C4', 'app'), ('A4', 'app'), ('C4EVO', 'app')]):
+    if not assure_compatibility(charger, _METRICS):
         return
 
+    model: str = charger.model
     step: int = 0
     all_channels: List[Dict[str, Union[str, int, bool]]] = []
-    first: bool = True
     writer: Optional[csv.DictWriter] = None
 
+    # The output mode doesn't change while looping, so the handler is selected only once.
+    # The packet is parsed once before calling it, the handlers only format the result.
+    def handle_text(_: bytearray, parsed: Dict[str, Union[str, int, bool]]) -> None:
+        """Prints the packet in a human readable form."""
+        print(packet_to_str(parsed, model))
+
+    def handle_dict(_: bytearray, parsed: Dict[str, Union[str, int, bool]]) -> None:
+        """Prints the parsed packet."""
+        print(parsed)
+
+    def handle_json(_: bytearray, parsed: Dict[str, Union[str, int, bool]]) -> None:
+        """Collects the parsed packet, the list is dumped when done."""
+        result_dict = dict(parsed)
+        result_dict['_measurement'] = step
+        all_channels.append(result_dict)
+
+    def handle_ndjson(_: bytearray, parsed: Dict[str, Union[str, int, bool]]) -> None:
+        """Prints the parsed packet as a single line of JSON right away."""
+        result_dict = dict(parsed)
+        result_dict['_measurement'] = step
+        sys.stdout.write(json.dumps(result_dict))
+        sys.stdout.write('\n')
+        sys.stdout.flush()
+
+    def handle_csv(_: bytearray, parsed: Dict[str, Union[str, int, bool]]) -> None:
+        """Writes the parsed packet as a row, and the header before the first row. The row is
+        flushed right away, so it shows up even if stdout is a pipe."""
+        nonlocal writer
+        if writer is None:
+            writer = csv.DictWriter(sys.stdout, parsed.keys())
+            writer.writeheader()
+        writer.writerow(parsed)
+        sys.stdout.flush()
+
+    def handle_raw(result: bytearray, _: None) -> None:
+        """Prints the payload as hex."""
+        print(result.hex(' '))
+
+    handlers: Dict[str, Callable[[bytearray, Optional[Dict[str, Union[str, int, bool]]]],
+                                 None]] = {
+        'text': handle_text, 'dict': handle_dict, 'json': handle_json, 'ndjson': handle_ndjson,
+        'csv': handle_csv, 'raw': handle_raw}
+    if output_mode not in handlers:
+        raise ValueError('Output mode "{}" is not implemented.'.format(output_mode))
+    handler = handlers[output_mode]
+    parse: bool = output_mode != 'raw'
+
     try:
         while count == 0 or step < count:
             step += 1
 
-            for i in channels:
-                charger.metrics(i)
-                result: bytearray
-                result = charger.read_packet()
+            # The request for the next channel is sent before the current response is read,
+            # and parsed, so the USB round-trip overlaps with the work done here.
+            if len(channels) > 0:
+                charger.metrics(channels[0])
 
-                if output_mode == 'text':
-                    print(packet_to_str(result, charger.model))
-                elif output_mode == 'dict':
-                    print(parse_packet(result, charger.model))
-                elif output_mode == 'json':
-                    result_dict = parse_packet(result, charger.model)
-                    result_dict['_measurement'] = step
-                    all_channels.append(result_dict)
-                elif output_mode == 'csv':
-                    result_dict = parse_packet(result, charger.model)
-                    if first:
-                        writer = csv.DictWriter(RedirectWriteToPrint(), result_dict.keys())
-                        writer.writeheader()
-                        first = False
-                    writer.writerow(result_dict)
-                elif output_mode == 'raw':
-                    print(' '.join(f'{x:02x}' for x in result))
+            for index in range(len(channels)):
+                if index + 1 < len(channels):
+                    charger.metrics(channels[index + 1])
+
+                result = charger.read_packet()
+                handler(result, __parse_cached__(bytes(result), model) if parse else None)
 
             if count == 0 or count - step != 0:
                 sleep(interval)
@@ -190,9 +257,7 @@ def reboot_to_boot_loader(charger: Charger, output_mode='text') -> None:
     :param charger: An usb.Device object for the charger as retrieved by isdttool.get_device
     :param output_mode: Either csv, test, json, or dict.
     """
-    if not assure_compatibility(charger, [('C4', 'app'), ('A4', 'app'), ('C4', 'boot loader'),
-                                          ('A4', 'boot loader'), ('C4EVO', 'app'),
-                                          ('C4EVO', 'boot loader')]):
+    if not assure_compatibility(charger, _ANY_MODE):
         return
 
     charger.boot_to_loader()
@@ -207,15 +272,13 @@ def verify_firmware(charger: Charger, file: BinaryIO, output_mode: str = 'text')
     :param file: The encrypted file as downloaded from ISDT
     :param output_mode: Either csv, test, json, or dict.
     """
-    if not assure_compatibility(charger, [('C4', 'boot loader'), ('A4', 'boot loader'),
-                                          ('C4EVO', 'boot loader')]):
+    if not assure_compatibility(charger, _BOOT_LOADER):
         return
 
-    decrypted_firmware = BytesIO()
-    header: Dict[str, int] = decrypt_firmware_image(file, decrypted_firmware)
-    if 'app_storage_offset' in header.keys() and \
-            'app_size' in header.keys() and \
-            'calculated_checksum' in header.keys():
+    from ..firmware import decrypt_firmware_image
+
+    header: Dict[str, int] = decrypt_firmware_image(file)
+    if all(key in header for key in ('app_storage_offset', 'app_size', 'calculated_checksum')):
         charger.verify_firmware(header['app_storage_offset'],
                                 header['app_size'],
                                 header['calculated_checksum'])
@@ -230,7 +293,7 @@ def display_sensors(charger: Charger, output_mode='text') -> None:
        :param charger: what charger to ask
        :param output_mode: Either csv, test, json, or dict.
     """
-    if not assure_compatibility(charger, [('C4', 'app')]):
+    if not assure_compatibility(charger, _SENSORS):
         return
 
     charger.read_some_sensors()
@@ -244,7 +307,7 @@ def display_channel_sensors(charger: Charger, channel: int, output_mode='text')
        :param channel: channel ID, 0 indexed
        :param output_mode: Either csv, test, json, or dict.
     """
-    if not assure_compatibility(charger, [('C4EVO', 'app')]):
+    if not assure_compatibility(charger, _CHANNEL_SENSORS):
         return
 
     charger.channel_sensors(channel)
@@ -257,7 +320,7 @@ def display_channel_voltages(charger: Charger, output_mode='text') -> None:
        :param charger: what charger to ask
        :param output_mode: Either csv, test, json, or dict.
     """
-    if not assure_compatibility(charger, [('Q8', 'app')]):
+    if not assure_compatibility(charger, _CHANNEL_VOLTAGES):
         return
 
     charger.channel_voltages()
@@ -270,16 +333,15 @@ def reboot_to_app(charger: Charger, output_mode='text') -> None:
     :param charger: An usb.Device object for the charger as retrieved by isdttool.get_device
     :param output_mode: Either csv, test, json, or dict.
     """
-    if not assure_compatibility(charger, [('C4', 'app'), ('A4', 'app'), ('C4', 'boot loader'),
-                                          ('A4', 'boot loader'), ('C4EVO', 'app'),
-                                          ('C4EVO', 'boot loader')]):
+    if not assure_compatibility(charger, _ANY_MODE):
         return
 
     charger.boot_to_app()
     print_simple_result(charger, output_mode)
 
 
-def write_raw_command(charger: Charger, command: bytearray, output_mode: str = 'text'):
+def write_raw_command(charger: Charger, command: Union[bytearray, Iterable[int]],
+                      output_mode: str = 'text'):
     """
     Sends a raw command to the charger. Don't use this.
     :param charger: The charger to ask.
@@ -288,8 +350,14 @@ def write_raw_command(charger: Charger, command: bytearray, output_mode: str = '
     """
     # Of course, this one doesn't care at all for compatibility.
 
-    print('About to write command: {}'.format(' '.join(f'{x:02x}' for x in command)))
-    charger.write_to_charger(command)
+    try:
+        payload = bytearray(command)
+    except ValueError as e:
+        print('Byte out of range: {}'.format(e), file=sys.stderr)
+        return
+
+    print('About to write command: {}'.format(payload.hex(' ')))
+    charger.write_to_charger(payload)
     print('Sent.')
     print_simple_result(charger, output_mode)
 
@@ -297,7 +365,7 @@ def write_raw_command(charger: Charger, command: bytearray, output_mode: str = '
 def monitor_state(charger: Charger,
                   func: Callable[[Optional[Dict[str, Union[str, int, bool]]],
                                   Dict[str, Union[str, int, bool]]], None],
-                  interval: float, period: Optional[int]) -> None:
+                  interval: float, period: Optional[int], wakeup: Optional[Event] = None) -> None:
     """
     Calls func with the parsed metrics packet if something changed, or the optional period has
     passed. Never stops, unless there is an unrecoverable exception.
@@ -307,21 +375,31 @@ def monitor_state(charger: Charger,
     :param interval: How often to poll the charger.
     :param period: How often to call func if even if nothing has changed. This is in multiples of
     interval. Ignored if None.
+    :param wakeup: If set, the charger is polled right away instead of waiting for the rest of
+    the interval, e.g. by a signal handler, or another thread that knows something happened.
+    It's cleared by monitor_state before every poll.
     """
+    model: str = charger.model
     state: List[Dict[str, Union[str, int, bool]]] = []
     max_channel: Optional[int] = None
 
-    # Discover channel count
+    # Discover channel count. Most chargers have four channels, so usually one batch does it.
 
-    for i in range(0, 256):
-        charger.metrics(i)
-        c_state = parse_packet(charger.read_packet(), charger.model)
-        if c_state['_channel exists']:
+    for first_channel in range(0, 256, _METRICS_BATCH_SIZE):
+        batch = charger.metrics_batch(
+            range(first_channel, min(first_channel + _METRICS_BATCH_SIZE, 256)))
+        for i, packet in enumerate(batch, first_channel):
+            c_state = __parse_cached__(bytes(packet), model)
+            if not c_state['_channel exists']:
+                break
             max_channel = i
-            state.append(c_state)
-            func(None, {**{'_reason': 'channel id', '_channel': i}, **c_state})
+            state.append(dict(c_state))  # Handed to func later, so not the cached one.
+            event: Dict[str, Union[str, int, bool]] = {'_reason': 'channel id', '_channel': i}
+            event.update(c_state)
+            func(None, event)
         else:
-            break
+            continue
+        break
 
     if max_channel is None:
         func(None, {'_reason': 'no channels'})
@@ -331,11 +409,16 @@ def monitor_state(charger: Charger,
 
     while True:
         current_iteration += 1
+        if wakeup is not None:
+            # Cleared before polling, not after waiting, so a wakeup that arrives in between
+            # isn't lost. One that arrives while polling just causes another poll.
+            wakeup.clear()
 
-        current_state: List[Dict[str, Union[str, int, bool]]] = []
-        for i in range(0, max_channel + 1):
-            charger.metrics(i)
-            current_state.append(parse_packet(charger.read_packet(), charger.model))
+        current_state: List[Dict[str, Union[str, int, bool]]] = \
+            [dict(__parse_cached__(bytes(packet), model))
+             for first_channel in range(0, max_channel + 1, _METRICS_BATCH_SIZE)
+             for packet in charger.metrics_batch(
+                 range(first_channel, min(first_channel + _METRICS_BATCH_SIZE, max_channel + 1)))]
 
         if period is not None and current_iteration % period == 0:
             for c in current_state:
@@ -345,17 +428,15 @@ def monitor_state(charger: Charger,
         for comp in zip(state, current_state):
             comp[1]['_iteration'] = current_iteration
 
-            if comp[0]['mode id'] != comp[1]['mode id']:
-                comp[1]['_reason'] = 'mode id'
-                func(comp[0], comp[1])
-
-            if comp[0]['chemistry id'] != comp[1]['chemistry id']:
-                comp[1]['_reason'] = 'chemistry id'
-                func(comp[0], comp[1])
-
-            if comp[0]['dimensions id'] != comp[1]['dimensions id']:
-                comp[1]['_reason'] = 'dimensions id'
-                func(comp[0], comp[1])
+            for key in WATCHED_KEYS:
+                if comp[0][key] != comp[1][key]:
+                    comp[1]['_reason'] = key
+                    func(comp[0], comp[1])
 
         state = current_state
-        sleep(interval)
+
+        # hidapi can't tell us when the charger has something to say, so this still polls.
+        if wakeup is None:
+            sleep(interval)
+        else:
+            wakeup.wait(interval)
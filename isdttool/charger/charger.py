@@ -3,14 +3,20 @@
 """This file contains functions to parse incoming packets, and to construct outgoing packets.
 It cares about checksums, and stuff."""
 import sys
-from typing import Optional, List, Tuple
+from struct import Struct
+from typing import Optional, List, Tuple, Iterable, Iterator, Dict, Callable, TYPE_CHECKING
 
 # noinspection PyPackageRequirements
 import hid
 
-import isdttool
 from .representation import parse_packet
 
+if TYPE_CHECKING:
+    import asyncio
+
+# Set through isdttool.set_debug. It's kept here, because it's checked for every frame.
+DEBUG_MODE: bool = False
+
 
 def debug_log(*args, **kwargs) -> None:
     """
@@ -18,7 +24,7 @@ def debug_log(*args, **kwargs) -> None:
     :param args: positional args for print
     :param kwargs: keyword args for print
     """
-    if isdttool.DEBUG_MODE:
+    if DEBUG_MODE:
         kwargs['file'] = sys.stderr
         print(*args, **kwargs)
 
@@ -29,13 +35,7 @@ def __escape_synchronization__(payload: bytearray) -> bytearray:
     :param payload: Input
     :return: a new bytearray
     """
-    result = bytearray()
-    for b in payload:
-        if b == 0xAA:
-            result.append(0xAA)
-        result.append(b)
-
-    return result
+    return bytearray(payload.replace(b'\xAA', b'\xAA\xAA'))
 
 
 def __unescape_synchronization__(payload: bytearray) -> bytearray:
@@ -44,20 +44,20 @@ def __unescape_synchronization__(payload: bytearray) -> bytearray:
     :param payload: To un-escape
     :return: a new bytearray
     """
-    sync_seen: bool = False
     result: bytearray = bytearray()
-    for b in payload:
-        if b == 0xAA:
-            if sync_seen:
-                result.append(0xAA)
-            sync_seen = not sync_seen
-        else:
-            if sync_seen:
+
+    # Pairs are collapsed from left to right, so whatever 0xAA is left in a part afterwards is a
+    # lone one, and gets dropped.
+    for i, part in enumerate(payload.split(b'\xAA\xAA')):
+        if i > 0:
+            result.append(0xAA)
+        if 0xAA in part:
+            # A lone 0xAA at the very end is just dropped, every other one is worth a warning.
+            for _ in range(part.count(0xAA) - (part[-1] == 0xAA)):
                 debug_log('Protocol warning: Sync seen in mid-packet. '
                           'Discarding, but keeping the next character.')
-
-            sync_seen = False
-            result.append(b)
+            part = part.replace(b'\xAA', b'')
+        result += part
 
     return result
 
@@ -69,15 +69,10 @@ def __preprocess_payload__(data: bytearray) -> bytearray:
     :param data: The payload to construct the packet from. Must be <= 255 in length.
     :return: The preprocessed payload.
     """
-    payload = bytearray()
-    payload.append(0x12)  # Computer to charger
-    payload.append(len(data) & 0xFF)
-    payload.extend(data)
+    payload = bytearray(_REQUEST_HEADER_STRUCT.pack(0x12, len(data) & 0xFF))  # Computer to charger
+    payload += data
 
-    checksum: int = 0
-    for b in payload:
-        checksum = (checksum + b) & 0xFF
-    payload.append(checksum)
+    payload.append(sum(payload) & 0xFF)  # 8 bit sum, truncating at the end is the same.
 
     payload = __escape_synchronization__(payload)
     payload.insert(0, 0xAA)
@@ -85,6 +80,26 @@ def __preprocess_payload__(data: bytearray) -> bytearray:
     return payload
 
 
+def __iterate_raw_frames__(preprocessed_payload: bytearray) -> Iterator[bytearray]:
+    """
+    Yields the frames with the correct chunk size, which contain the payload. There are
+    (len(preprocessed_payload) + 61) // 62 of them.
+    :param preprocessed_payload: The packet data as returned by __preprocess_payload__.
+    :return: The frames to send, one after another.
+    """
+    # Slicing the view doesn't copy, so every chunk is copied only once, into its frame.
+    view = memoryview(preprocessed_payload)
+
+    for i in range(0, len(view), 62):
+        p = view[i:i + 62]
+        this_frame = bytearray(2 + len(p))
+        this_frame[0] = 0x01  # This is a request
+        this_frame[1] = len(p)
+        this_frame[2:] = p
+
+        yield this_frame
+
+
 def __generate_raw_frames__(payload: bytearray) -> List[bytearray]:
     """
     Generates the frames with with the correct chunk size, which contain the payload.
@@ -93,21 +108,31 @@ def __generate_raw_frames__(payload: bytearray) -> List[bytearray]:
     :param payload: The packet data.
     :return: A list of the frames to send.
     """
-    preprocessed_payload = __preprocess_payload__(payload)
-    split_payload = [preprocessed_payload[i:min(len(preprocessed_payload), i + 62)]
-                     for i in range(0, len(preprocessed_payload), 62)]
+    return list(__iterate_raw_frames__(__preprocess_payload__(payload)))
 
-    generated_frames: List[bytearray] = []
 
-    for p in split_payload:
-        this_frame = bytearray()
-        this_frame.append(0x01)  # This is a request
-        this_frame.append(len(p))
-        this_frame.extend(p)
+def __padded_frames__(payload: bytearray) -> Tuple[bytes, ...]:
+    """
+    Generates the frames like __generate_raw_frames__, and pads them to the report size.
+    :param payload: The packet data.
+    :return: The frames, ready to be written to the device.
+    """
+    return tuple(bytes(f).ljust(64, b'\x00') for f in __generate_raw_frames__(payload))
 
-        generated_frames.append(this_frame)
 
-    return generated_frames
+# Start of a request before escaping: direction, and length.
+_REQUEST_HEADER_STRUCT = Struct('BB')
+
+# Start of a packet: synchronization, direction, and length.
+_PACKET_HEADER_STRUCT = Struct('BBB')
+
+# Arguments of the firmware verification: offset, size, and checksum.
+_VERIFY_STRUCT = Struct('<III')
+
+# Commands without arguments never change, so their frames are built only once.
+_STATIC_FRAMES: Dict[bytes, Tuple[bytes, ...]] = {
+    command: __padded_frames__(bytearray(command))
+    for command in (b'\x00', b'\xc8', b'\xe0', b'\xf0\xac', b'\xf8', b'\xe4', b'\xfc\xca')}
 
 
 class Charger:
@@ -139,28 +164,39 @@ class Charger:
         """
 
         expected_packet_length: Optional[int] = None
-        packet_data: Optional[bytearray] = None
+        # The packet as sent, still escaped. It's unescaped in one go once it's complete, because
+        # an escaped 0xAA may be split across two frames.
+        escaped_data: bytearray = bytearray()
+        # Looked up once, the loop below may run for several frames.
+        read = self.__device__.read if captured_frames is None else None
 
         # We read 3 bytes more than we think we need, because the packet length as stated in the
-        # packet does not contain the header of the packet, and its checksum.
-        while expected_packet_length is None or len(packet_data) < expected_packet_length + 3:
+        # packet does not contain the header of the packet, and its checksum. Unescaping drops
+        # every 0xAA but keeps one of each pair, so that's the length the data will have.
+        while expected_packet_length is None or \
+                len(escaped_data) - escaped_data.count(0xAA) + escaped_data.count(b'\xAA\xAA') \
+                < expected_packet_length + 3:
             frame_as_received: Optional[bytearray]
             if captured_frames is None:
                 try:
                     frame_as_received: bytearray = bytearray(
-                        self.__device__.read(max_length=64, timeout_ms=200))
+                        read(max_length=64, timeout_ms=200))
                 except OSError as e:  # While this seems useless, it reminds me it may raise
                     # exceptions on timeout.
                     raise e
-                debug_log('Reading', bytes(frame_as_received).hex())
+                if DEBUG_MODE:  # Saves formatting every frame for nothing.
+                    debug_log('Reading', frame_as_received.hex())
             else:
                 frame_as_received = captured_frames.pop(0)  # This is for unit-testing.
-                debug_log('Using user provided frame:', bytes(frame_as_received).hex())
+                if DEBUG_MODE:
+                    debug_log('Using user provided frame:', frame_as_received.hex())
 
             if len(frame_as_received) < 3:
                 debug_log('Protocol error: Frame too short:', len(frame_as_received), 'bytes.',
                           'Returning already captured data.')
-                return packet_data
+                if expected_packet_length is None:
+                    return None
+                return __unescape_synchronization__(escaped_data)
 
             if frame_as_received[0] != 1 and frame_as_received[0] != 2:
                 debug_log('Protocol warning: Neither request nor response: 0x{:02X}'
@@ -174,35 +210,39 @@ class Charger:
             # to the total length of the actually received frame ensures we don't read out of
             # bounds.
 
-            frame_body = frame_as_received[2:frame_length]
+            # A view, the body is copied only once, into escaped_data.
+            frame_body = memoryview(frame_as_received)[2:frame_length]
 
             if expected_packet_length is None:
-                if frame_body[0] != 0xAA:
+                sync, direction, expected_packet_length = _PACKET_HEADER_STRUCT.unpack_from(
+                    frame_body)
+                if sync != 0xAA:
                     debug_log('Protocol warning: '
                               'Initial frame of packet is missing synchronization.')
-                if frame_body[1] != 0x12 and frame_body[1] != 0x21:
+                if direction != 0x12 and direction != 0x21:
                     debug_log('Protocol warning: '
                               'Direction is neither computer to charger nor charger to computer, '
-                              'but 0x{:02X}'.format(frame_body[1]))
-                expected_packet_length = frame_body[2]
-                packet_data = __unescape_synchronization__(frame_body[1:])
+                              'but 0x{:02X}'.format(direction))
+                escaped_data += frame_body[1:]
             else:
-                packet_data.extend(__unescape_synchronization__(frame_body))
+                escaped_data += frame_body
+
+        packet_data: bytearray = __unescape_synchronization__(escaped_data)
 
         # We read _at least_ enough data to match the announced length plus header plus checksum,
         # and then we cut the actual payload out of it. The following byte will be the checksum.
 
+        # The buffer is trimmed in place rather than sliced, which would copy it twice.
         checksum_from_packet: int = packet_data[expected_packet_length + 2]
-        packet_data = packet_data[:expected_packet_length + 2]
-        checksum: int = 0x00
-        for b in packet_data:
-            checksum = (checksum + b) & 0xFF
+        del packet_data[expected_packet_length + 2:]
+        checksum: int = sum(packet_data) & 0xFF
 
         if checksum != checksum_from_packet:
             debug_log('Protocol warning: Checksum wrong. calculated 0x{:02X}, in packet 0x{:02X}.'
                       .format(checksum, checksum_from_packet))
 
-        return packet_data[2:]  # The first 2 bytes aren't payload.
+        del packet_data[:2]  # The first 2 bytes aren't payload.
+        return packet_data
 
     def write_to_charger(self, payload: bytearray) -> None:
         """
@@ -210,18 +250,29 @@ class Charger:
         about everything, including actually sending it.
         :param payload: The packet data to send to the device. Must be smaller than 255 bytes.
         """
-        frames = __generate_raw_frames__(payload)
-        debug_log('Writing', len(payload), 'bytes, split into', len(frames), 'frames.')
+        preprocessed_payload = __preprocess_payload__(payload)
+        debug_log('Writing', len(payload), 'bytes, split into',
+                  (len(preprocessed_payload) + 61) // 62, 'frames.')
+        # The frames are padded, and written one by one, instead of being collected first.
+        self.__write_frames__(bytes(f).ljust(64, b'\x00')
+                              for f in __iterate_raw_frames__(preprocessed_payload))
+
+    def __write_frames__(self, frames: Iterable[bytes]) -> None:
+        """
+        Writes already generated, and padded frames to the device.
+        :param frames: The frames as returned by __padded_frames__
+        """
+        write = self.__device__.write
         for f in frames:
-            f.extend(b'\x00' * (64 - len(f)))
-            debug_log('Writing', bytes(f).hex())
-            self.__device__.write(f)
+            if DEBUG_MODE:
+                debug_log('Writing', f.hex())
+            write(f)
 
     def link_test(self) -> None:
         """
         Sends a well-supported nop command.
         """
-        self.write_to_charger(bytearray([0x00]))
+        self.__write_frames__(_STATIC_FRAMES[b'\x00'])
 
     def rename_device(self, new_name: str):
         """
@@ -239,7 +290,7 @@ class Charger:
         Requests the value of the unique device ID register of the STM32-like MCU.
         See ST's RM0008, sec. 30.2
         """
-        self.write_to_charger(bytearray([0xc8]))
+        self.__write_frames__(_STATIC_FRAMES[b'\xc8'])
 
     def metrics(self, channel: int) -> None:
         """
@@ -248,17 +299,32 @@ class Charger:
         """
         self.write_to_charger(bytearray([0xde, channel]))
 
+    def metrics_batch(self, channels: Iterable[int]) -> List[bytearray]:
+        """
+        Requests metrics for several charging channels at once. All requests are written before
+        the first response is read, so the USB round-trips overlap instead of adding up. The
+        responses are buffered by the HID layer, and come back in the order they were requested.
+        Keep the batch small, the input report queue of hidapi is limited.
+        :param channels: 0-indexed channel numbers
+        :return: The packet data for each channel, in the same order as channels.
+        """
+        channels = list(channels)
+        for channel in channels:
+            self.metrics(channel)
+
+        return [self.read_packet() for _ in channels]
+
     def version(self) -> None:
         """
         Requests version information from the charger.
         """
-        self.write_to_charger(bytearray([0xe0]))
+        self.__write_frames__(_STATIC_FRAMES[b'\xe0'])
 
     def boot_to_loader(self) -> None:
         """
         Immediately reboots the charger to boot loader mode.
         """
-        self.write_to_charger(bytearray([0xf0, 0xac]))
+        self.__write_frames__(_STATIC_FRAMES[b'\xf0\xac'])
 
     def verify_firmware(self, app_storage_offset: int, app_size: int, calculated_checksum: int) \
             -> None:
@@ -270,16 +336,14 @@ class Charger:
         :return:
         """
         cmd = bytearray(b'\xf6\x35\x00')
-        cmd.extend(int.to_bytes(app_storage_offset, signed=False, length=4, byteorder='little'))
-        cmd.extend(int.to_bytes(app_size, signed=False, length=4, byteorder='little'))
-        cmd.extend(int.to_bytes(calculated_checksum, signed=False, length=4, byteorder='little'))
+        cmd.extend(_VERIFY_STRUCT.pack(app_storage_offset, app_size, calculated_checksum))
         self.write_to_charger(cmd)
 
     def read_some_sensors(self) -> None:
         """
         Reads some sensor value whose meaning remains partially unknown.
         """
-        self.write_to_charger(bytearray([0xf8]))
+        self.__write_frames__(_STATIC_FRAMES[b'\xf8'])
 
     def channel_sensors(self, channel: int) -> None:
         """
@@ -291,13 +355,13 @@ class Charger:
         """
         Reads some channel measurements. Like channel_sensors, but without parameter. Found on Q8.
         """
-        self.write_to_charger(bytearray([0xe4]))
+        self.__write_frames__(_STATIC_FRAMES[b'\xe4'])
 
     def boot_to_app(self) -> None:
         """
         Immediately reboots the charger to app mode.
         """
-        self.write_to_charger(bytearray([0xfc, 0xca]))
+        self.__write_frames__(_STATIC_FRAMES[b'\xfc\xca'])
 
     def model_and_mode(self) -> Tuple[str, str]:
         """
@@ -314,6 +378,87 @@ class Charger:
                                               if link_test_result['inside boot loader'] else 'app')
 
 
+class AsyncCharger:
+    """Wraps a charger for use with asyncio. hidapi only offers blocking calls, so every
+    request/response pair runs in the default executor. A lock keeps the pairs of one charger
+    from interleaving, but several chargers can be driven concurrently from a single loop. A
+    cancelled request keeps the charger until its response has been read anyway.
+    Only the requests the charger answers are offered, each returns the packet data as returned
+    by Charger.read_packet."""
+
+    def __init__(self, charger: Charger) -> None:
+        self.charger = charger
+        self.__lock__: Optional['asyncio.Lock'] = None  # Created lazily, see __transfer__.
+        self.__lock_loop__: Optional['asyncio.AbstractEventLoop'] = None
+
+    async def __transfer__(self, request: Callable[[], None]) -> bytearray:
+        """
+        Sends a request, and waits for the response without blocking the event loop.
+        :param request: Writes the request to the charger.
+        :return: The packet data as returned by Charger.read_packet
+        """
+        # asyncio takes longer to import than the rest of the package, and only this needs it.
+        import asyncio
+
+        # Locks are bound to a loop, so there's one for each, e.g. for successive asyncio.run.
+        loop = asyncio.get_running_loop()
+        if self.__lock__ is None or self.__lock_loop__ is not loop:
+            self.__lock__ = asyncio.Lock()
+            self.__lock_loop__ = loop
+
+        def transfer() -> bytearray:
+            request()
+            return self.charger.read_packet()
+
+        async with self.__lock__:
+            future = loop.run_in_executor(None, transfer)
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # The thread can't be stopped, and it's still talking to the charger. The lock
+                # is kept until it's done, or the next request would interleave with it.
+                while not future.done():
+                    try:
+                        await asyncio.wait((future,))
+                    except asyncio.CancelledError:
+                        pass
+                raise
+
+    async def link_test(self) -> bytearray:
+        """See Charger.link_test."""
+        return await self.__transfer__(self.charger.link_test)
+
+    async def get_mcu_serial_number(self) -> bytearray:
+        """See Charger.get_mcu_serial_number."""
+        return await self.__transfer__(self.charger.get_mcu_serial_number)
+
+    async def metrics(self, channel: int) -> bytearray:
+        """See Charger.metrics."""
+        return await self.__transfer__(lambda: self.charger.metrics(channel))
+
+    async def version(self) -> bytearray:
+        """See Charger.version."""
+        return await self.__transfer__(self.charger.version)
+
+    async def verify_firmware(self, app_storage_offset: int, app_size: int,
+                              calculated_checksum: int) -> bytearray:
+        """See Charger.verify_firmware."""
+        return await self.__transfer__(lambda: self.charger.verify_firmware(
+            app_storage_offset, app_size, calculated_checksum))
+
+    async def read_some_sensors(self) -> bytearray:
+        """See Charger.read_some_sensors."""
+        return await self.__transfer__(self.charger.read_some_sensors)
+
+    async def channel_sensors(self, channel: int) -> bytearray:
+        """See Charger.channel_sensors."""
+        return await self.__transfer__(lambda: self.charger.channel_sensors(channel))
+
+    async def channel_voltages(self) -> bytearray:
+        """See Charger.channel_voltages."""
+        return await self.__transfer__(self.charger.channel_voltages)
+
+
 def get_device(model_name: str = 'auto', mode: str = 'auto',
                product_id: Optional[int] = None, vendor_id: Optional[int] = None,
                path: Optional[str] = None) -> Charger:
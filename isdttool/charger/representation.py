@@ -2,275 +2,389 @@
 # coding=utf-8
 
 """These functions parse packets after they have been received from the charger."""
-from collections import defaultdict
-from struct import unpack_from
-from typing import Tuple, Optional, Union, Dict, Any
+from functools import lru_cache
+from struct import Struct
+from typing import Tuple, Optional, Union, Dict, Callable
 
+# Anything parse_packet can read from. Slicing a memoryview doesn't copy.
+_Packet = Union[bytes, bytearray, memoryview]
+# What parse_packet returns.
+_Result = Dict[str, Union[str, int, bool]]
+# The mode, chemistry, and dimension strings of the model.
+_Strings = Tuple[Dict[int, str], Dict[int, str], Dict[int, str]]
 
-def parse_packet(packet: bytearray, model: Optional[str]) -> \
+# Layout of the metrics packet after the opcode. Compiled once, it's parsed for every poll.
+_METRICS_STRUCT = Struct('<BBBBBBBhhHhhiI')
+# The same goes for the other fixed layouts.
+_BUILD_TIME_STRUCT = Struct('5B')
+_SENSORS_STRUCT = Struct('<xxxxxxHHHHHHHHBBBBBx')
+_UNKNOWN_VOLTAGES_STRUCT = Struct('<9H')
+_CHANNEL_METRICS_STRUCT = Struct('<BHHHxxB')
+_CHANNEL_VOLTAGES_HEADER_STRUCT = Struct('<BHIHI')
+
+# The strings for the mode, chemistry, and dimension ids in the metrics. Ids which are missing
+# are unknown.
+_A4_C4_MODE_STRINGS: Dict[int, str] = {
+    0: 'idling', 1: 'waiting', 2: 'reversed', 3: 'charging', 4: 'charged', 5: 'discharging',
+    6: 'discharged', 7: 'storage', 8: 'storage done', 9: 'cycling', 10: 'cycling done',
+    11: 'analysis', 12: 'analysis done'}
+
+# ID 4 seems to be unused.
+# NiMH!!! (6) are overcharged Ni cell. Set to NiMH, and insert a Li-Ion to show up.
+# Eneloop (7) doesn't seem as if it is any different from NiMH,
+# maybe has different Delta-V.
+_A4_C4_CHEMISTRY_STRINGS: Dict[int, str] = {
+    0: 'auto', 1: 'LiHv', 2: 'Li-Ion', 3: 'LiPO4', 5: 'NiZn', 6: 'NiMH!!!', 7: 'Eneloop',
+    8: 'NiCd', 9: 'NiMH'}
+
+_A4_DIMENSION_STRINGS: Dict[int, str] = {0: 'AA(A)'}
+_C4_DIMENSION_STRINGS: Dict[int, str] = {0: 'AAA', 1: 'AA', 2: '18650', 3: '26650', 4: 'empty'}
+
+# 'Cut off!!' is displayed on some errors like selecting NiMH for a Li-Ion thus making
+# the charger detect a far too high cell voltage. You can also get it when you frequently
+# disconnect, and reinsert a battery so quickly that it won't interrupt the charging. You
+# then also get an "UnKnown Error! 0x400" on the display. What about 14, and 16?
+# Firmware suggests some mode strings ("Charge State"?),
+# e.g. "csBattUnload" (empty slot), "csAnalysising" (analysing), but also something like
+# "tsTrickleChging", and also talks about balancing. Maybe this charger shares firmware
+# parts with some of their LiIon chargers.
+_C4EVO_MODE_STRINGS: Dict[int, str] = {
+    0: 'idling', 1: 'waiting', 2: 'reversed', 3: 'charging', 4: 'charged', 5: 'discharging',
+    6: 'discharged', 7: 'storage', 8: 'storage done', 9: 'cycling', 10: 'cycling done',
+    11: 'analysis', 12: 'analysis done', 13: 'activate', 15: 'destroy', 17: 'Cut off'}
+
+# C4EVO doesn't have Eneloop, and NiCd anymore. No big deal though.
+# The C4EVO has no information about dimensions.
+_C4EVO_CHEMISTRY_STRINGS: Dict[int, str] = {
+    0: 'LiHv', 1: 'LiIon', 2: 'LiFe', 3: 'NiZn', 4: 'NiMH'}
+
+# I don't have a Q8, but got some metrics dumps in issue #2. Thanks for that.
+# Unfortunately, the Q8 isn't really verbose with this opcode. There might be more, but
+# this would require hands-on testing.
+_Q8_MODE_STRINGS: Dict[int, str] = {3: 'charging'}
+_Q8_CHEMISTRY_STRINGS: Dict[int, str] = {9: 'LiIon'}
+
+_NO_STRINGS: Dict[int, str] = {}
+
+# The strings of each supported model. Without a model, everything will be unknown.
+_MODEL_STRINGS: Dict[Optional[str], _Strings] = {
+    'A4': (_A4_C4_MODE_STRINGS, _A4_C4_CHEMISTRY_STRINGS, _A4_DIMENSION_STRINGS),
+    'C4': (_A4_C4_MODE_STRINGS, _A4_C4_CHEMISTRY_STRINGS, _C4_DIMENSION_STRINGS),
+    'C4EVO': (_C4EVO_MODE_STRINGS, _C4EVO_CHEMISTRY_STRINGS, _NO_STRINGS),
+    'Q8': (_Q8_MODE_STRINGS, _Q8_CHEMISTRY_STRINGS, _NO_STRINGS),
+    'ignore': (_NO_STRINGS, _NO_STRINGS, _NO_STRINGS),
+    None: (_NO_STRINGS, _NO_STRINGS, _NO_STRINGS),
+}
+
+
+def parse_packet(packet: _Packet, model: Optional[str]) -> \
         Dict[str, Union[str, int, bool]]:
     """
     This function returns a dict which corresponds to the packet. Might be wrong sometimes.
-    :param packet: The payload as retrieved by read_packet
+    :param packet: The payload as retrieved by read_packet, or a bytes, or memoryview of it.
     :param model: Different models have different meanings of some fields.
     Specify either 'A4', 'C4', 'C4EVO', or 'Q8'. If None, ignore.
     :return: A dict with self explaining keys.
     """
-    mode_strings = defaultdict(lambda: 'unknown', {})
-    chemistry_strings = defaultdict(lambda: 'unknown', {})
-    dimension_strings = defaultdict(lambda: 'unknown', {})
-    if model in ['A4', 'C4']:
-        mode_strings.update(
-            {0: 'idling', 1: 'waiting', 2: 'reversed', 3: 'charging', 4: 'charged',
-             5: 'discharging', 6: 'discharged', 7: 'storage', 8: 'storage done',
-             9: 'cycling', 10: 'cycling done', 11: 'analysis', 12: 'analysis done'})
-
-        # ID 4 seems to be unused.
-        # NiMH!!! (6) are overcharged Ni cell. Set to NiMH, and insert a Li-Ion to show up.
-        # Eneloop (7) doesn't seem as if it is any different from NiMH,
-        # maybe has different Delta-V.
-        chemistry_strings.update({
-            0: 'auto', 1: 'LiHv', 2: 'Li-Ion', 3: 'LiPO4', 5: 'NiZn', 6: 'NiMH!!!', 7: 'Eneloop',
-            8: 'NiCd', 9: 'NiMH'
-        })
-
-        if model == 'A4':
-            dimension_strings[0] = 'AA(A)'
-        elif model == 'C4':
-            dimension_strings.update({0: 'AAA', 1: 'AA', 2: '18650', 3: '26650', 4: 'empty'})
-    elif model in ['C4EVO']:
-        # 'Cut off!!' is displayed on some errors like selecting NiMH for a Li-Ion thus making
-        # the charger detect a far too high cell voltage. You can also get it when you frequently
-        # disconnect, and reinsert a battery so quickly that it won't interrupt the charging. You
-        # then also get an "UnKnown Error! 0x400" on the display. What about 14, and 16?
-        # Firmware suggests some mode strings ("Charge State"?),
-        # e.g. "csBattUnload" (empty slot), "csAnalysising" (analysing), but also something like
-        # "tsTrickleChging", and also talks about balancing. Maybe this charger shares firmware
-        # parts with some of their LiIon chargers.
-        mode_strings.update(
-            {0: 'idling', 1: 'waiting', 2: 'reversed', 3: 'charging', 4: 'charged',
-             5: 'discharging', 6: 'discharged', 7: 'storage', 8: 'storage done',
-             9: 'cycling', 10: 'cycling done', 11: 'analysis', 12: 'analysis done',
-             13: 'activate', 15: 'destroy', 17: 'Cut off'})
-
-        # C4EVO doesn't have Eneloop, and NiCd anymore. No big deal though.
-        chemistry_strings.update({0: 'LiHv', 1: 'LiIon', 2: 'LiFe', 3: 'NiZn', 4: 'NiMH'})
-        # The C4EVO has no information about dimensions.
-    elif model in ['Q8']:
-        # I don't have a Q8, but got some metrics dumps in issue #2. Thanks for that.
-        # Unfortunately, the Q8 isn't really verbose with this opcode. There might be more, but
-        # this would require hands-on testing. 
-        mode_strings.update({3: 'charging'})
-        chemistry_strings.update({9: 'LiIon'})
-    elif model == 'ignore':
-        pass  # Everything will be unknown then.
-    else:
+    strings = _MODEL_STRINGS.get(model)
+    if strings is None:
         raise ValueError(f'Model {model} is not supported.')
 
-    result: Dict[str, Union[str, int, bool]] = dict()
-
-    if packet[0] == 0x01:
-        result['_type'] = 'link test'
-        if len(packet) == 4:
-            # C4 has only a 4 byte response while in app, it misses the device model
-            # C4EVO always misses the model but when in bl mode it indicates the mode...
-            result['_malformed'] = False
-            result['result'] = True
-            result['inside boot loader'] = packet[1] == 0x91
-        elif len(packet) == 10:  # C4 in BL mode as well as A4 in any mode has a 10 byte response
-            result['_malformed'] = False
-            result['result'] = True
-            result['inside boot loader'] = packet[1] == 0
-            result['model'] = packet[2:].decode('ascii').rstrip('\x00')
-        else:
-            result['_malformed'] = True
-    elif packet[0] == 0x03:
-        result['_type'] = 'voltage-test-mode'
+    opcode = packet[0]
+    # The metrics are polled over, and over again, so they skip the lookups below.
+    if opcode == 0xdf and len(packet) == 0x1a:
+        return __parse_metrics__(packet, model, strings)
+
+    if not _VALID_LENGTHS.get(opcode, -1) >> len(packet) & 1:
+        return {'_type': _TYPE_NAMES[opcode], '_malformed': True}
+
+    parser = _PARSERS_BY_LENGTH.get((opcode, len(packet)))
+    if parser is None:
+        parser = _PARSERS.get(opcode, __parse_unknown__)
+    return parser(packet, model, strings)
+
+
+def __parse_link_test__(packet: _Packet, model: Optional[str], strings: _Strings) -> _Result:
+    """Parses the response to the link test, see parse_packet."""
+    result: _Result = {'_type': 'link test'}
+    if len(packet) == 4:
+        # C4 has only a 4 byte response while in app, it misses the device model
+        # C4EVO always misses the model but when in bl mode it indicates the mode...
         result['_malformed'] = False
-    elif packet[0] == 0xe1:  # Device information
-        result['_type'] = 'device information'
-        if len(packet) != 31 and len(packet) != 29 and len(packet) != 39:
-            result['_malformed'] = True
-        else:
-            result['hw version'] = '{}.{}.{}.{}'.format(
-                int(packet[9]), int(packet[10]), int(packet[11]), int(packet[12]))
-            result['bl version'] = '{}.{}.{}.{}'.format(
-                int(packet[13]), int(packet[14]), int(packet[15]), int(packet[16]))
-            result['app version'] = '{}.{}.{}.{}'.format(
-                int(packet[17]), int(packet[18]), int(packet[19]), int(packet[20]))
-            result['model name'] = packet[21:31].decode('ascii').rstrip('\x00')
-
-            if len(packet) == 39:
-                # This is a total guess.
-                # These are some of the last bytes of the BL section in flash.
-                result['loader build time?'] = '20{:02d}-{:02d}-{:02d} {:02d}:{:02d}'.format(
-                    *unpack_from('5B', packet, 0x21))
-
-            result['_malformed'] = False
-    elif packet[0] == 0xf1:
-        result['_type'] = 'reboot to boot loader'
-        if len(packet) != 2:
-            result['_malformed'] = True
-        else:
-            if packet[1] == 0x00:
-                result['rebooting'] = True
-                result['next stop'] = 'boot loader'
-                result['_malformed'] = False
-            elif packet[1] == 0x02:
-                result['rebooting'] = False
-                result['_malformed'] = False
-            else:
-                result['_malformed'] = True
-    elif packet[0] == 0xc1:
-        result['_type'] = 'rename device'
-        if len(packet) != 2:
-            result['_malformed'] = True
-        else:
-            result['renamed'] = True
-            result['rebooting'] = True
-            result['next stop'] = 'app'
-            result['_malformed'] = False
-    elif packet[0] == 0xc9:
-        result['_type'] = 'serial number'
-        if len(packet) != 13:
-            result['_malformed'] = True
-        else:
-            result['_malformed'] = False
-            result['serial number'] = bytes(packet[1:]).hex()
-    elif packet[0] == 0xfd:
-        result['_type'] = 'reboot to app'
-        if len(packet) != 2 and len(packet) != 1:
-            result['_malformed'] = True
-        else:
-            result['rebooting'] = True
-            result['next stop'] = 'app'
-            result['_malformed'] = False
-            result['coming from'] = ('boot loader' if len(packet) == 1 else 'app')
-    elif packet[0] == 0xdf:
-        result['_type'] = 'metrics'
-        if len(packet) == 1:
-            result['_channel exists'] = False
-            result['_malformed'] = False
-        elif len(packet) != 0x1a:
-            result['_malformed'] = True
-        else:
-            # Unfortunately, it seems as if the values on the chargers GUI are ceil-rounded,
-            # whereas the transmitted values are floor-rounded. This can causes discrepancies
-            # between the values shown for the temperature, and resistance.
-
-            result['_channel exists'] = True
-
-            stats = unpack_from('<BBBBBBBhhHhhiI', packet, 1)
-            result['channel'] = stats[0]
-
-            result['mode id'] = stats[1]
-            result['mode string'] = mode_strings[stats[1]]
-
-            result['chemistry id'] = stats[2]
-            result['chemistry string'] = chemistry_strings[stats[2]]
-
-            result['dimensions id'] = stats[3]
-            result['dimensions string'] = dimension_strings[stats[3]]
-
-            result['temperature'] = stats[4]
-            result['internal_temperature'] = stats[5]
-
-            # Not 100 % sure about that. C4's fan turns on if > int(55.5), turns off if < int(
-            # 47.5), or turns off if there is no charge flowing, e.g. all batteries are removed,
-            # or put in waiting. Maybe it also stops when all batteries are charged,
-            # but I didn't test. Unfortunately the temperature is not visible in GUI, and it is
-            # only sent as integers. But the value range seems appropriate for a Celsius
-            # temperature for a charging MOSFET. ISDT manufactures Lithium chargers, so it also
-            # make perfectly sense to measure temperatures exactly. The fan seems to be
-            # temperature driven, but only on, or off. Additionally, it is transmitted next to
-            # the cell temperature.
-
-            result['progress'] = stats[6]
-
-            result['charging voltage'] = stats[7]
-            result['charging current'] = stats[8]
-            result['resistance'] = stats[9]
-            result['power'] = stats[10]
-            result['energy'] = stats[11]
-            result['capacity or peak voltage'] = stats[12]
-            result['time'] = stats[13]
-
-            result['_malformed'] = False
-    elif packet[0] == 0xf7:
-        result['_type'] = 'app checksum'
-        if len(packet) != 15:
-            result['_malformed'] = True
-        else:
-            result['checksum matches'] = (packet[2] == 0x00)
-            result['_malformed'] = False
-    elif packet[0] == 0xf9:
-        result['_type'] = 'sensors'
-        if len(packet) != 0x1d:
-            result['_malformed'] = True
-        else:
-            sensors: Tuple[Any] = \
-                unpack_from('<xxxxxxHHHHHHHHBBBBBx', packet, 1)
-
-            result['psu voltage'] = sensors[0]
-            result['usb voltage'] = sensors[1]
-            result['unknown voltage 1'] = sensors[2]
-            result['unknown voltage 2'] = sensors[3]
-            result['unknown voltage 3'] = sensors[4]
-            result['unknown voltage 4'] = sensors[5]
-            result['unknown voltage 5'] = sensors[6]
-            result['unknown voltage 6'] = sensors[7]
-            result['channel temperature 1'] = sensors[8]
-            result['channel temperature 2'] = sensors[9]
-            result['channel temperature 3'] = sensors[10]
-            result['channel temperature 4'] = sensors[11]
-            result['unknown temperature'] = sensors[12]
-
-            result['_malformed'] = False
-    elif packet[0] == 0xfb:
-        result['_type'] = 'unknown voltages'
-        if len(packet) != 19:
+        result['result'] = True
+        result['inside boot loader'] = packet[1] == 0x91
+    else:  # C4 in BL mode as well as A4 in any mode has a 10 byte response
+        result['_malformed'] = False
+        result['result'] = True
+        result['inside boot loader'] = packet[1] == 0
+        result['model'] = str(packet[2:], 'ascii').rstrip('\x00')
+    return result
+
+
+def __parse_voltage_test_mode__(packet: _Packet, model: Optional[str], strings: _Strings) \
+        -> _Result:
+    """Parses the response to the voltage test mode command, see parse_packet."""
+    return {'_type': 'voltage-test-mode', '_malformed': False}
+
+
+def __parse_device_information__(packet: _Packet, model: Optional[str], strings: _Strings) \
+        -> _Result:
+    """Parses the device information, see parse_packet."""
+    result: _Result = {'_type': 'device information'}
+    result['hw version'] = f'{packet[9]}.{packet[10]}.{packet[11]}.{packet[12]}'
+    result['bl version'] = f'{packet[13]}.{packet[14]}.{packet[15]}.{packet[16]}'
+    result['app version'] = f'{packet[17]}.{packet[18]}.{packet[19]}.{packet[20]}'
+    result['model name'] = str(packet[21:31], 'ascii').rstrip('\x00')
+
+    if len(packet) == 39:
+        # This is a total guess.
+        # These are some of the last bytes of the BL section in flash.
+        year, month, day, hour, minute = _BUILD_TIME_STRUCT.unpack_from(packet, 0x21)
+        result['loader build time?'] = \
+            f'20{year:02d}-{month:02d}-{day:02d} {hour:02d}:{minute:02d}'
+
+    result['_malformed'] = False
+    return result
+
+
+def __parse_reboot_to_boot_loader__(packet: _Packet, model: Optional[str], strings: _Strings) \
+        -> _Result:
+    """Parses the response to the reboot to boot loader command, see parse_packet."""
+    result: _Result = {'_type': 'reboot to boot loader'}
+    if packet[1] == 0x00:
+        result['rebooting'] = True
+        result['next stop'] = 'boot loader'
+        result['_malformed'] = False
+    elif packet[1] == 0x02:
+        result['rebooting'] = False
+        result['_malformed'] = False
+    else:
+        result['_malformed'] = True
+    return result
+
+
+def __parse_rename_device__(packet: _Packet, model: Optional[str], strings: _Strings) \
+        -> _Result:
+    """Parses the response to the rename command, see parse_packet."""
+    result: _Result = {'_type': 'rename device'}
+    result['renamed'] = True
+    result['rebooting'] = True
+    result['next stop'] = 'app'
+    result['_malformed'] = False
+    return result
+
+
+def __parse_serial_number__(packet: _Packet, model: Optional[str], strings: _Strings) \
+        -> _Result:
+    """Parses the MCU serial number, see parse_packet."""
+    result: _Result = {'_type': 'serial number'}
+    result['_malformed'] = False
+    result['serial number'] = packet[1:].hex()
+    return result
+
+
+def __parse_reboot_to_app__(packet: _Packet, model: Optional[str], strings: _Strings) \
+        -> _Result:
+    """Parses the response to the reboot to app command, see parse_packet."""
+    result: _Result = {'_type': 'reboot to app'}
+    result['rebooting'] = True
+    result['next stop'] = 'app'
+    result['_malformed'] = False
+    result['coming from'] = ('boot loader' if len(packet) == 1 else 'app')
+    return result
+
+
+def __parse_missing_channel__(packet: _Packet, model: Optional[str], strings: _Strings) \
+        -> _Result:
+    """Parses the metrics of a channel that doesn't exist, see parse_packet. Those are only the
+    opcode."""
+    return {'_type': 'metrics', '_channel exists': False, '_malformed': False}
+
+
+def __parse_metrics__(packet: _Packet, model: Optional[str], strings: _Strings) -> _Result:
+    """Parses the metrics of a channel, see parse_packet. The packet must be 0x1a bytes long."""
+    mode_strings, chemistry_strings, dimension_strings = strings
+    result: _Result = {'_type': 'metrics'}
+
+    # Unfortunately, it seems as if the values on the chargers GUI are ceil-rounded,
+    # whereas the transmitted values are floor-rounded. This can causes discrepancies
+    # between the values shown for the temperature, and resistance.
+
+    result['_channel exists'] = True
+
+    channel, mode_id, chemistry_id, dimensions_id, temperature, internal_temperature, progress, \
+        voltage, current, resistance, power, energy, capacity, time = \
+        _METRICS_STRUCT.unpack_from(packet, 1)
+    result['channel'] = channel
+
+    result['mode id'] = mode_id
+    result['mode string'] = mode_strings.get(mode_id, 'unknown')
+
+    result['chemistry id'] = chemistry_id
+    result['chemistry string'] = chemistry_strings.get(chemistry_id, 'unknown')
+
+    result['dimensions id'] = dimensions_id
+    result['dimensions string'] = dimension_strings.get(dimensions_id, 'unknown')
+
+    result['temperature'] = temperature
+    result['internal_temperature'] = internal_temperature
+
+    # Not 100 % sure about that. C4's fan turns on if > int(55.5), turns off if < int(
+    # 47.5), or turns off if there is no charge flowing, e.g. all batteries are removed,
+    # or put in waiting. Maybe it also stops when all batteries are charged,
+    # but I didn't test. Unfortunately the temperature is not visible in GUI, and it is
+    # only sent as integers. But the value range seems appropriate for a Celsius
+    # temperature for a charging MOSFET. ISDT manufactures Lithium chargers, so it also
+    # make perfectly sense to measure temperatures exactly. The fan seems to be
+    # temperature driven, but only on, or off. Additionally, it is transmitted next to
+    # the cell temperature.
+
+    result['progress'] = progress
+
+    result['charging voltage'] = voltage
+    result['charging current'] = current
+    result['resistance'] = resistance
+    result['power'] = power
+    result['energy'] = energy
+    result['capacity or peak voltage'] = capacity
+    result['time'] = time
+
+    result['_malformed'] = False
+    return result
+
+
+def __parse_app_checksum__(packet: _Packet, model: Optional[str], strings: _Strings) \
+        -> _Result:
+    """Parses the result of the firmware verification, see parse_packet."""
+    result: _Result = {'_type': 'app checksum'}
+    result['checksum matches'] = (packet[2] == 0x00)
+    result['_malformed'] = False
+    return result
+
+
+def __parse_sensors__(packet: _Packet, model: Optional[str], strings: _Strings) -> _Result:
+    """Parses the sensor values, see parse_packet."""
+    result: _Result = {'_type': 'sensors'}
+    result['psu voltage'], result['usb voltage'], \
+        result['unknown voltage 1'], result['unknown voltage 2'], result['unknown voltage 3'], \
+        result['unknown voltage 4'], result['unknown voltage 5'], result['unknown voltage 6'], \
+        result['channel temperature 1'], result['channel temperature 2'], \
+        result['channel temperature 3'], result['channel temperature 4'], \
+        result['unknown temperature'] = _SENSORS_STRUCT.unpack_from(packet, 1)
+
+    result['_malformed'] = False
+    return result
+
+
+def __parse_unknown_voltages__(packet: _Packet, model: Optional[str], strings: _Strings) \
+        -> _Result:
+    """Parses the voltages whose meaning is unknown, see parse_packet."""
+    result: _Result = {'_type': 'unknown voltages'}
+    result['_malformed'] = False
+
+    result['unknown voltage 1'], result['unknown voltage 2'], result['unknown voltage 3'], \
+        result['unknown voltage 4'], result['unknown voltage 5'], result['unknown voltage 6'], \
+        result['unknown voltage 7'], result['unknown voltage 8'], result['unknown voltage 9'] = \
+        _UNKNOWN_VOLTAGES_STRUCT.unpack_from(packet, 1)
+    return result
+
+
+@lru_cache(maxsize=None)
+def __channel_voltages_layout__(channel_count: int) -> Tuple[Struct, Tuple[str, ...]]:
+    """
+    The layout of the channel voltages depends on the channel count. A charger always reports
+    the same count, so it's compiled once per count, along with the keys of the voltages.
+    :param channel_count: As reported in the packet.
+    :return: The layout of that many voltages, and their keys.
+    """
+    return Struct(f'<{channel_count}H'), \
+        tuple(f'channel voltage {index}' for index in range(channel_count))
+
+
+def __parse_channel_sensors__(packet: _Packet, model: Optional[str], strings: _Strings) \
+        -> _Result:
+    """Parses the channel metrics of the C4EVO, or the channel voltages of the Q8, see
+    parse_packet. Both answer to the same opcode."""
+    result: _Result = {}
+    if model == 'C4EVO':
+        result['_type'] = 'channel metrics'
+        result['_malformed'] = False
+        result['channel'], result['psu voltage'], result['charging voltage'], \
+            result['current'], result['temperature'] = \
+            _CHANNEL_METRICS_STRUCT.unpack_from(packet, 1)
+    else:
+        result['_type'] = 'channel voltages'
+        result['_malformed'] = False
+        if len(packet) < 14:
             result['_malformed'] = True
         else:
-            result['_malformed'] = False
-
-            voltages = unpack_from('<9H', packet, 1)
-            result['unknown voltage 1'] = voltages[0]
-            result['unknown voltage 2'] = voltages[1]
-            result['unknown voltage 3'] = voltages[2]
-            result['unknown voltage 4'] = voltages[3]
-            result['unknown voltage 5'] = voltages[4]
-            result['unknown voltage 6'] = voltages[5]
-            result['unknown voltage 7'] = voltages[6]
-            result['unknown voltage 8'] = voltages[7]
-            result['unknown voltage 9'] = voltages[8]
-    elif packet[0] == 0xe5:
-        if model == 'C4EVO':
-            result['_type'] = 'channel metrics'
-            result['_malformed'] = False
-            result['channel'], result['psu voltage'], result['charging voltage'], \
-                result['current'], result['temperature'] = unpack_from('<BHHHxxB', packet, 1)
-        else:
-            result['_type'] = 'channel voltages'
-            result['_malformed'] = False
-            if len(packet) < 14:
+            result['channel count'], result['psu voltage'], result['some 32 bit integer'], \
+                result['total voltage'], result['another 32 bit integer'] = \
+                _CHANNEL_VOLTAGES_HEADER_STRUCT.unpack_from(packet, 1)
+            if len(packet) < result['channel count'] * 2 + 14:
                 result['_malformed'] = True
             else:
-                result['channel count'], result['psu voltage'], result['some 32 bit integer'], \
-                    result['total voltage'], result['another 32 bit integer'] = \
-                    unpack_from('<BHIHI', packet, 1)
-                if len(packet) < result['channel count'] * 2 + 14:
-                    result['_malformed'] = True
-                else:
-                    for index, voltage in \
-                            enumerate(unpack_from(f'<{result["channel count"]}H', packet, 14)):
-                        result[f'channel voltage {index}'] = voltage
-    else:
-        result['_type'] = 'unknown'
-
+                voltages, keys = __channel_voltages_layout__(result['channel count'])
+                result.update(zip(keys, voltages.unpack_from(packet, 14)))
     return result
 
 
-def packet_to_str(response: Union[bytearray, Dict[str, Union[str, int, bool]]], model: str) -> str:
+def __parse_unknown__(packet: _Packet, model: Optional[str], strings: _Strings) -> _Result:
+    """Fallback for opcodes I don't know, see parse_packet."""
+    return {'_type': 'unknown'}
+
+
+# The opcode is the first byte of the payload. Looking it up beats walking through an if-chain.
+_PARSERS: Dict[int, Callable[[_Packet, Optional[str], _Strings], _Result]] = {
+    0x01: __parse_link_test__,
+    0x03: __parse_voltage_test_mode__,
+    0xe1: __parse_device_information__,
+    0xf1: __parse_reboot_to_boot_loader__,
+    0xc1: __parse_rename_device__,
+    0xc9: __parse_serial_number__,
+    0xfd: __parse_reboot_to_app__,
+    0xf7: __parse_app_checksum__,
+    0xf9: __parse_sensors__,
+    0xfb: __parse_unknown_voltages__,
+    0xe5: __parse_channel_sensors__,
+}
+
+# The metrics are parsed differently depending on the length. Those are looked up by opcode, and
+# length first, so their parsers don't have to check the length again. Metrics of a channel
+# that exists never get here, parse_packet handles them right away.
+_PARSERS_BY_LENGTH: Dict[Tuple[int, int], Callable[[_Packet, Optional[str], _Strings], _Result]] = {
+    (0xdf, 1): __parse_missing_channel__,
+}
+
+# The lengths a packet may have, as bit mask. Bit n is set if a length of n is valid. Packets
+# with any other length are malformed, so their parsers don't check the length at all. The type
+# names are only needed for those malformed packets.
+_VALID_LENGTHS: Dict[int, int] = {
+    0x01: 1 << 4 | 1 << 10,
+    0xe1: 1 << 29 | 1 << 31 | 1 << 39,
+    0xf1: 1 << 2,
+    0xc1: 1 << 2,
+    0xc9: 1 << 13,
+    0xfd: 1 << 1 | 1 << 2,
+    0xdf: 1 << 1 | 1 << 0x1a,
+    0xf7: 1 << 15,
+    0xf9: 1 << 0x1d,
+    0xfb: 1 << 19,
+}
+_TYPE_NAMES: Dict[int, str] = {
+    0x01: 'link test', 0xe1: 'device information', 0xf1: 'reboot to boot loader',
+    0xc1: 'rename device', 0xc9: 'serial number', 0xfd: 'reboot to app', 0xdf: 'metrics',
+    0xf7: 'app checksum', 0xf9: 'sensors', 0xfb: 'unknown voltages'}
+
+
+class _NADict(dict):
+    """A packet whose missing values are n/a. The formatters index it like the packet."""
+
+    def __missing__(self, key: str) -> str:
+        return 'n/a'
+
+
+def packet_to_str(response: Union[_Packet, Dict[str, Union[str, int, bool]]], model: str) -> str:
     """
     Convert a packet to a human readable string.
     :param response: The packet data as received by read_packet, or preparsed as dict.
@@ -278,92 +392,165 @@ def packet_to_str(response: Union[bytearray, Dict[str, Union[str, int, bool]]],
     :return: A human readable string.
     """
     result: Optional[str]
-    packet: defaultdict[str, Union[str, int, bool]]
+    packet: Dict[str, Union[str, int, bool]]
 
-    if isinstance(response, bytearray):
-        packet = defaultdict(lambda: 'n/a', parse_packet(response, model))
+    if isinstance(response, (bytes, bytearray, memoryview)):
+        packet = parse_packet(response, model)
     elif isinstance(response, dict):
-        packet = defaultdict(lambda: 'n/a', **response)
+        packet = response
     else:
         raise ValueError()
 
-    if packet['_type'] == 'link test':
-        result = 'Link test ' + 'succeeded' if packet['result'] else 'failed'
-        result += '\nCurrently running the ' + ('boot loader' if packet['inside boot loader'] else
-                                                'app')
-    elif packet['_type'] == 'device information':
-        result = ('Model name: {}\n'
-                  'Hardware version {}\n'
-                  'Boot loader version {}\n'
-                  'OS/App version {}').format(packet['model name'], packet['hw version'],
-                                              packet['bl version'], packet['app version'])
-    elif packet['_type'] == 'reboot to boot loader':
-        result = 'Rebooting to boot loader.'
-    elif packet['_type'] == 'rename device':
-        result = 'Device renamed, rebooting.'
-    elif packet['_type'] == 'reboot to app':
-        result = 'Rebooting to app.'
-    elif packet['_type'] == 'metrics':
-        if packet['_channel exists']:
-            voltage = packet['charging voltage'] / 1000
-            current = packet['charging current'] / 1000
-            result = ('CH {channel} {mode string:>13}: {chemistry string:>7} '
-                      '{dimensions string:>5} at {progress:>3} %, {temperature:>2} °C, '
-                      '{voltage:>6.3f} V * {current:>6.3f} A, '
-                      '{resistance:>3d} Ohm, {time} s'
-                      ).format(voltage=voltage, current=current, **packet)
-        else:
-            result = 'Channel does not exist.'
-    elif packet['_type'] == 'sensors':
-        result = ('Sensors:\n'
-                  'PSU Voltage: {psu voltage} mV\n'
-                  'USB Voltage: {usb voltage} mV\n'
-                  'Unknown Voltage 1: {unknown voltage 1} mV\n'
-                  'Unknown Voltage 2: {unknown voltage 2} mV\n'
-                  'Unknown Voltage 3: {unknown voltage 3} mV\n'
-                  'Unknown Voltage 4: {unknown voltage 4} mV\n'
-                  'Unknown Voltage 5: {unknown voltage 5} mV\n'
-                  'Unknown Voltage 6: {unknown voltage 6} mV\n'
-                  'Channel Temperature 1: {channel temperature 1} °C\n'
-                  'Channel Temperature 2: {channel temperature 2} °C\n'
-                  'Channel Temperature 3: {channel temperature 3} °C\n'
-                  'Channel Temperature 4: {channel temperature 4} °C\n'
-                  'Unknown Temperature: {unknown temperature} °C\n').format(**packet)
-    elif packet['_type'] == 'app checksum':
-        if packet['checksum matches']:
-            result = 'The checksum matches the checksum of the image in flash.'
-        else:
-            result = 'The checksum DOES NOT match the checksum of the image in flash.'
-    elif packet['_type'] == 'serial number':
-        result = 'Serial Number: ' + packet['serial number']
-    elif packet['_type'] == 'unknown voltages':
-        result = ('Voltages:\n'
-                  'Unknown Voltage 1: {unknown voltage 1} mV\n'
-                  'Unknown Voltage 2: {unknown voltage 2} mV\n'
-                  'Unknown Voltage 3: {unknown voltage 3} mV\n'
-                  'Unknown Voltage 4: {unknown voltage 4} mV\n'
-                  'Unknown Voltage 5: {unknown voltage 5} mV\n'
-                  'Unknown Voltage 6: {unknown voltage 6} mV\n'
-                  'Unknown Voltage 7: {unknown voltage 7} mV\n'
-                  'Unknown Voltage 8: {unknown voltage 8} mV\n').format(**packet)
-    elif packet['_type'] == 'channel metrics':
-        result = f'Channel: {packet["channel"]}\n' \
-                 f'PSU Voltage: {packet["psu voltage"]} mV\n' \
-                 f'Charging voltage: {packet["charging voltage"]} mV\n' \
-                 f'Current: {packet["current"]} mA\n' \
-                 f'Temperature: {packet["temperature"]} °C\n'
-    elif packet['_type'] == 'channel voltages':
-        if packet['_malformed']:
-            result = None
-        else:
-            result = f'Channel Count: {packet["channel count"]}\n' \
-                     f'PSU Voltage: {packet["psu voltage"]} mV\n'
-            for i in range(packet['channel count']):
-                result += f'Channel {i} Voltage: {packet[f"channel voltage {i}"]} mV\n'
-    else:
-        result = None
+    # Only malformed packets miss keys, so only they need the n/a fallback. A packet that
+    # doesn't even say if it's malformed is treated like one.
+    malformed = packet.get('_malformed', True)
+    if malformed:
+        packet = _NADict(packet)
 
-    if packet['_malformed']:
+    result = _FORMATTERS.get(packet.get('_type'), __format_unknown__)(packet)
+
+    if malformed:
         return 'MALFORMED!\n' + (result if result is not None else 'Unknown packet type.')
     else:
         return result
+
+
+# The text representations. They're filled in with format_map, so missing values become n/a.
+_DEVICE_INFORMATION_TEMPLATE = ('Model name: {model name}\n'
+                                'Hardware version {hw version}\n'
+                                'Boot loader version {bl version}\n'
+                                'OS/App version {app version}')
+
+_SENSORS_TEMPLATE = ('Sensors:\n'
+                     'PSU Voltage: {psu voltage} mV\n'
+                     'USB Voltage: {usb voltage} mV\n'
+                     'Unknown Voltage 1: {unknown voltage 1} mV\n'
+                     'Unknown Voltage 2: {unknown voltage 2} mV\n'
+                     'Unknown Voltage 3: {unknown voltage 3} mV\n'
+                     'Unknown Voltage 4: {unknown voltage 4} mV\n'
+                     'Unknown Voltage 5: {unknown voltage 5} mV\n'
+                     'Unknown Voltage 6: {unknown voltage 6} mV\n'
+                     'Channel Temperature 1: {channel temperature 1} °C\n'
+                     'Channel Temperature 2: {channel temperature 2} °C\n'
+                     'Channel Temperature 3: {channel temperature 3} °C\n'
+                     'Channel Temperature 4: {channel temperature 4} °C\n'
+                     'Unknown Temperature: {unknown temperature} °C\n')
+
+_UNKNOWN_VOLTAGES_TEMPLATE = ('Voltages:\n'
+                              'Unknown Voltage 1: {unknown voltage 1} mV\n'
+                              'Unknown Voltage 2: {unknown voltage 2} mV\n'
+                              'Unknown Voltage 3: {unknown voltage 3} mV\n'
+                              'Unknown Voltage 4: {unknown voltage 4} mV\n'
+                              'Unknown Voltage 5: {unknown voltage 5} mV\n'
+                              'Unknown Voltage 6: {unknown voltage 6} mV\n'
+                              'Unknown Voltage 7: {unknown voltage 7} mV\n'
+                              'Unknown Voltage 8: {unknown voltage 8} mV\n')
+
+_CHANNEL_METRICS_TEMPLATE = ('Channel: {channel}\n'
+                             'PSU Voltage: {psu voltage} mV\n'
+                             'Charging voltage: {charging voltage} mV\n'
+                             'Current: {current} mA\n'
+                             'Temperature: {temperature} °C\n')
+
+
+def __format_link_test__(packet: _Result) -> Optional[str]:
+    """Formats the link test, see packet_to_str."""
+    return f"Link test {'succeeded' if packet['result'] else 'failed'}\n" \
+           f"Currently running the {'boot loader' if packet['inside boot loader'] else 'app'}"
+
+
+def __format_device_information__(packet: _Result) -> Optional[str]:
+    """Formats the device information, see packet_to_str."""
+    return _DEVICE_INFORMATION_TEMPLATE.format_map(packet)
+
+
+def __format_reboot_to_boot_loader__(packet: _Result) -> Optional[str]:
+    """Formats the reboot to boot loader response, see packet_to_str."""
+    return 'Rebooting to boot loader.'
+
+
+def __format_rename_device__(packet: _Result) -> Optional[str]:
+    """Formats the rename response, see packet_to_str."""
+    return 'Device renamed, rebooting.'
+
+
+def __format_reboot_to_app__(packet: _Result) -> Optional[str]:
+    """Formats the reboot to app response, see packet_to_str."""
+    return 'Rebooting to app.'
+
+
+def __format_metrics__(packet: _Result) -> Optional[str]:
+    """Formats the metrics of a channel, see packet_to_str."""
+    if packet['_channel exists']:
+        # This is printed for every channel, and every poll, so it's an f-string instead of a
+        # template, which would need the packet unpacked into keyword arguments.
+        return (f"CH {packet['channel']} {packet['mode string']:>13}: "
+                f"{packet['chemistry string']:>7} {packet['dimensions string']:>5} "
+                f"at {packet['progress']:>3} %, {packet['temperature']:>2} °C, "
+                f"{packet['charging voltage'] / 1000:>6.3f} V * "
+                f"{packet['charging current'] / 1000:>6.3f} A, "
+                f"{packet['resistance']:>3d} Ohm, {packet['time']} s")
+    else:
+        return 'Channel does not exist.'
+
+
+def __format_sensors__(packet: _Result) -> Optional[str]:
+    """Formats the sensor values, see packet_to_str."""
+    return _SENSORS_TEMPLATE.format_map(packet)
+
+
+def __format_app_checksum__(packet: _Result) -> Optional[str]:
+    """Formats the result of the firmware verification, see packet_to_str."""
+    if packet['checksum matches']:
+        return 'The checksum matches the checksum of the image in flash.'
+    else:
+        return 'The checksum DOES NOT match the checksum of the image in flash.'
+
+
+def __format_serial_number__(packet: _Result) -> Optional[str]:
+    """Formats the MCU serial number, see packet_to_str."""
+    return 'Serial Number: ' + packet['serial number']
+
+
+def __format_unknown_voltages__(packet: _Result) -> Optional[str]:
+    """Formats the voltages whose meaning is unknown, see packet_to_str."""
+    return _UNKNOWN_VOLTAGES_TEMPLATE.format_map(packet)
+
+
+def __format_channel_metrics__(packet: _Result) -> Optional[str]:
+    """Formats the channel metrics of the C4EVO, see packet_to_str."""
+    return _CHANNEL_METRICS_TEMPLATE.format_map(packet)
+
+
+def __format_channel_voltages__(packet: _Result) -> Optional[str]:
+    """Formats the channel voltages of the Q8, see packet_to_str."""
+    if packet['_malformed']:
+        return None
+
+    result = f'Channel Count: {packet["channel count"]}\n' \
+             f'PSU Voltage: {packet["psu voltage"]} mV\n'
+    for i in range(packet['channel count']):
+        result += f'Channel {i} Voltage: {packet[f"channel voltage {i}"]} mV\n'
+    return result
+
+
+def __format_unknown__(packet: _Result) -> Optional[str]:
+    """Fallback for packets without a text representation, see packet_to_str."""
+    return None
+
+
+# Keyed by the _type of the parsed packet.
+_FORMATTERS: Dict[str, Callable[[_Result], Optional[str]]] = {
+    'link test': __format_link_test__,
+    'device information': __format_device_information__,
+    'reboot to boot loader': __format_reboot_to_boot_loader__,
+    'rename device': __format_rename_device__,
+    'reboot to app': __format_reboot_to_app__,
+    'metrics': __format_metrics__,
+    'sensors': __format_sensors__,
+    'app checksum': __format_app_checksum__,
+    'serial number': __format_serial_number__,
+    'unknown voltages': __format_unknown_voltages__,
+    'channel metrics': __format_channel_metrics__,
+    'channel voltages': __format_channel_voltages__,
+}
@@ -17,9 +17,11 @@ from isdttool.charger import display_metrics, display_version, display_link_test
     monitor_state
 from isdttool.charger.actions import display_channel_sensors, display_channel_voltages
 from isdttool.charger.charger import enumerate_devices
-from isdttool.firmware import decrypt_firmware_image, print_firmware_info
 from isdttool.charger.representation import parse_packet, packet_to_str
 
+# The mode ids of charged, discharged, storage done, cycling done, and analysis done.
+_FINAL_MODES = frozenset((4, 6, 8, 10, 12))
+
 
 def firmware_decrypt(encrypted: BinaryIO, output: BinaryIO) -> None:
     """
@@ -27,6 +29,8 @@ def firmware_decrypt(encrypted: BinaryIO, output: BinaryIO) -> None:
     :param encrypted: IO (aka file) to read the fw from
     :param output: IO (aka file) to write the fw to
     """
+    from isdttool.firmware import decrypt_firmware_image
+
     header = decrypt_firmware_image(encrypted, output)
 
     print('Embedded checksum:     0x{0:08x}'.format(header['embedded_checksum']))
@@ -44,6 +48,9 @@ def handle_monitor_state_event_factory(command: str, only_interesting: bool) \
     from subprocess import run
     from os import environ
 
+    # The events have the same keys every time, so their environment names are cached.
+    environment_names: Dict[str, str] = {}
+
     def handle_monitor_state_event(last_state: Dict[str, Union[str, int, bool]],
                                    event: Dict[str, Union[str, int, bool]]) -> None:
         """
@@ -55,14 +62,13 @@ def handle_monitor_state_event_factory(command: str, only_interesting: bool) \
         readable: str
 
         if event['_reason'] == 'mode id':
-            readable = ('Channel {channel}: Mode changed to from {mode_was} to {mode_is}.'
-                        .format(channel=event['channel'],
-                                mode_is=event['mode string'],
-                                mode_was=last_state['mode string']))
-            if event['mode id'] in [4, 6, 8, 10, 12]:
-                readable += ('\n{dimensions string} {chemistry string}: {mode string}\n'
-                             '{energy} mWh, {resistance} Ω, {time} s, {temperature} °C'
-                             .format(**event))
+            readable = f'Channel {event["channel"]}: Mode changed to from ' \
+                       f'{last_state["mode string"]} to {event["mode string"]}.'
+            if event['mode id'] in _FINAL_MODES:
+                readable += f'\n{event["dimensions string"]} {event["chemistry string"]}: ' \
+                            f'{event["mode string"]}\n' \
+                            f'{event["energy"]} mWh, {event["resistance"]} Ω, ' \
+                            f'{event["time"]} s, {event["temperature"]} °C'
         elif event['_reason'] == 'dimensions id':
             readable = f'Channel {event["channel"]}: Dimensions changed to from ' \
                        f'{event["dimensions string"]} to {last_state["dimensions string"]}.'
@@ -74,22 +80,21 @@ def handle_monitor_state_event_factory(command: str, only_interesting: bool) \
             current: float = event['charging current'] / 1000
             power: float = event['power'] / 1000
             if event['dimensions id'] == 4:
-                readable = 'Channel {channel}: Periodic update: empty'.format(**event)
+                readable = f'Channel {event["channel"]}: Periodic update: empty'
             else:
-                # charged, discharged, storaged, cycled, analyzed
-                if event['mode id'] in [4, 6, 8, 10, 12]:
-                    readable = ('Channel {channel}: Periodic update:\n'
-                                '{dimensions string} {chemistry string}: {mode string}\n'
-                                '{energy} mWh, {resistance} Ω, {time} s, {temperature} °C'
-                                .format(**event))
+                if event['mode id'] in _FINAL_MODES:
+                    readable = f'Channel {event["channel"]}: Periodic update:\n' \
+                               f'{event["dimensions string"]} {event["chemistry string"]}: ' \
+                               f'{event["mode string"]}\n' \
+                               f'{event["energy"]} mWh, {event["resistance"]} Ω, ' \
+                               f'{event["time"]} s, {event["temperature"]} °C'
                 else:
-                    readable = ('Channel {channel}: Periodic update:\n'
-                                '{dimensions string} {chemistry string}: '
-                                '{mode string} @ {progress} %\n'
-                                '{voltage} V * {current} A = {div_power} W\n'
-                                '{energy} mWh, {resistance} Ω, {time} s, {temperature} °C'
-                                .format(**event, voltage=voltage, current=current,
-                                        div_power=power))
+                    readable = f'Channel {event["channel"]}: Periodic update:\n' \
+                               f'{event["dimensions string"]} {event["chemistry string"]}: ' \
+                               f'{event["mode string"]} @ {event["progress"]} %\n' \
+                               f'{voltage} V * {current} A = {power} W\n' \
+                               f'{event["energy"]} mWh, {event["resistance"]} Ω, ' \
+                               f'{event["time"]} s, {event["temperature"]} °C'
         elif event['_reason'] == 'no channels':
             readable = "The charger doesn't have any channels. Bailing."
         elif event['_reason'] == 'channel id':
@@ -104,24 +109,26 @@ def handle_monitor_state_event_factory(command: str, only_interesting: bool) \
         env = environ.copy()
         env['HUMAN_READABLE'] = readable
 
-        for k in event.keys():
-            env[k.upper().replace(' ', '_')] = str(event[k])
+        for k, v in event.items():
+            name = environment_names.get(k)
+            if name is None:
+                name = environment_names[k] = k.upper().replace(' ', '_')
+            env[name] = str(v)
 
-        print(
-            'Reason: {reason}. Calling {command}'.format(reason=event['_reason'], command=command))
+        print(f'Reason: {event["_reason"]}. Calling {command}')
         run(command, shell=True, env=env)
 
     return handle_monitor_state_event
 
 
-def get_argument_parser() -> ArgumentParser:
-    """Constructs an appropriate ArgumentParser."""
+def hex_int(x: str) -> int:
+    """Helper function to allow the input of non-prefixed hex
+    integers which is the common representation for USB IDs. """
+    return int(x, 16)
 
-    def hex_int(x: str) -> int:
-        """Helper function to allow the input of non-prefixed hex
-        integers which is the common representation for USB IDs. """
-        return int(x, 16)
 
+def get_argument_parser() -> ArgumentParser:
+    """Constructs an appropriate ArgumentParser."""
     parser = ArgumentParser(description='Tool to interact with ISDT C4, and A4 chargers, maybe '
                                         'compatible devices. It looks as if the protocol should '
                                         'be the same for most chargers.')
@@ -141,7 +148,7 @@ def get_argument_parser() -> ArgumentParser:
                              'multiple chargers. Overrides --vid, and --pid')
 
     parser.add_argument('--output', '-o', default='text', type=str,
-                        choices=['text', 'json', 'csv', 'dict', 'raw'],
+                        choices=['text', 'json', 'ndjson', 'csv', 'dict', 'raw'],
                         help='How the output should be formatted.')
 
     parser.add_argument('--debug', '-d', default=False, action='store_const', const=True,
@@ -307,7 +314,7 @@ def main() -> None:
     # a = parser.parse_args('-m ignore decode '
     #                       'e1433400000000000001000004010000030101001043340000000000000000'
     #                       ''.split())
-    isdttool.DEBUG_MODE = a.debug
+    isdttool.set_debug(a.debug)
 
     if a.mode == '':
         parser.print_usage()
@@ -324,6 +331,7 @@ def main() -> None:
     elif a.mode == 'decrypt-fw':
         firmware_decrypt(a.file, a.outfile)
     elif a.mode == 'fw-info':
+        from isdttool.firmware import print_firmware_info
         print_firmware_info(a.file)
     elif a.mode == 'decode':
         if a.model == 'auto':
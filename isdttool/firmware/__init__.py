@@ -2,91 +2,107 @@
 
 """Tools for reversing ISDT firmware files. Works for all tested chargers so far."""
 
-from struct import unpack, error
-from typing import BinaryIO, Tuple, Dict, Any, Optional
-from io import BytesIO
-
-
-def decrypt_firmware_image(encrypted: BinaryIO, output: BinaryIO) -> Dict[str, int]:
+from array import array
+from sys import byteorder
+from struct import Struct, error
+from typing import BinaryIO, Tuple, Dict, Optional
+
+# The header in front of the encrypted image.
+_HEADER_STRUCT = Struct('<8I')
+# The image is encrypted in blocks of one 32 bit word. The pointer to the info structure is one.
+_BLOCK_STRUCT = Struct('<I')
+# The information structure inside the decrypted image.
+_INFO_STRUCT = Struct('<I8s8b2I')
+# An array typecode with 32 bit items to sum the blocks. 'I' is usually it, but it's only
+# guaranteed to be at least 16 bits wide. If there's none, the blocks are summed one by one.
+_WORD_TYPECODE: Optional[str] = next((t for t in 'IL' if array(t).itemsize == 4), None)
+
+
+def decrypt_firmware_image(encrypted: BinaryIO, output: Optional[BinaryIO] = None) \
+        -> Dict[str, int]:
     """
     Decrypts the firmware image into output, and return the firmware header as a dict.
     :param encrypted: IO (aka file) where the firmware is stored
     :param output: IO (might also be something different than a file) to write the
-    decrypted firmware to.
+    decrypted firmware to. Leave it out if you only need the header.
     :return: The firmware header
     """
-    header: bytes = encrypted.read(32)
+    header: bytes = encrypted.read(_HEADER_STRUCT.size)
 
     try:
-        unpacked_header: Tuple[Any] = unpack('<8I', header)
+        encryption_key, file_checksum, app_storage_offset, data_storage_offset, app_size, \
+            data_size, initial_baud_rate, fast_baud_rate = _HEADER_STRUCT.unpack(header)
     except error:  # Thank you Mr Struct for such useful exception names.
         return {}
 
-    encryption_key: int = unpacked_header[0]
-    file_checksum: int = unpacked_header[1]
-    app_storage_offset: int = unpacked_header[2]
-    data_storage_offset: int = unpacked_header[3]
-    app_size: int = unpacked_header[4]
-    data_size: int = unpacked_header[5]
-    initial_baud_rate: int = unpacked_header[6]
-    fast_baud_rate: int = unpacked_header[7]
-
     key1: int = encryption_key
     key2: int = file_checksum
 
-    calculated_checksum: int = 0
-    read: bytes = encrypted.read(4)
-    while len(read) >= 4:
-        block, = unpack('<I', read)
+    # Read the whole image at once, and decrypt it into one buffer. Trailing bytes that don't
+    # make up a whole block are dropped.
+    encrypted_data: bytes = encrypted.read()
+    decrypted_data: bytearray = bytearray(len(encrypted_data) & ~3)
+    offset: int = 0
+    for block, in _BLOCK_STRUCT.iter_unpack(memoryview(encrypted_data)[:len(decrypted_data)]):
         block ^= key2
         key2 = (key2 + key1) & 0xFFFFFFFF
         key2 ^= key1
 
-        output.write(int.to_bytes(block, length=4, byteorder='little', signed=False))
-        calculated_checksum = (calculated_checksum + block) & 0xFFFFFFFF
-        read = encrypted.read(4)
-
-    information_structure = dict()
-    if output.seekable() and output.readable():
-        unpacked_information_structure: Optional[Tuple] = None  # Large tuple...
-        try:
-            # Encryption done, now read the information structure inside the image:
-            # As far as I can tell, the pointer to the info structure starts at 40.
-            output.seek(40)
-            pointer: int = int.from_bytes(output.read(4), byteorder='little',
-                                          signed=False) - app_storage_offset
-            # Seek into the file to where the structure is located
-            output.seek(pointer)
-            unpacked_information_structure = unpack('<I8s8b2I', output.read(28))
-            # Rewind the tape after we read the structure.
-            output.seek(0)
-            information_structure['info_structure_pointer'] = pointer
-        except (error, IOError):
-            pass
-
-        if unpacked_information_structure is not None:
-            information_structure['magic'] = unpacked_information_structure[0]
-            information_structure['model_name'] = unpacked_information_structure[1].rstrip(
-                b'\x00').decode('ascii')
-            information_structure['hw_version'] = '{}.{}.{}.{}'.format(
-                unpacked_information_structure[2],
-                unpacked_information_structure[3],
-                unpacked_information_structure[4],
-                unpacked_information_structure[5])
-            information_structure['sw_version'] = '{}.{}.{}.{}'.format(
-                unpacked_information_structure[6],
-                unpacked_information_structure[7],
-                unpacked_information_structure[8],
-                unpacked_information_structure[9])
-            information_structure['entrypoint'] = unpacked_information_structure[10]
-            information_structure['app_image_size'] = unpacked_information_structure[11]
-
-    return dict(embedded_checksum=file_checksum, calculated_checksum=calculated_checksum,
-                app_storage_offset=app_storage_offset, data_storage_offset=data_storage_offset,
-                app_size=app_size,
-                data_size=data_size, initial_baud_rate=initial_baud_rate,
-                fast_baud_rate=fast_baud_rate,
-                **information_structure)
+        _BLOCK_STRUCT.pack_into(decrypted_data, offset, block)
+        offset += 4
+
+    if output is not None:
+        output.write(decrypted_data)
+
+    # The checksum is the sum of all decrypted blocks. Summing them as an array is done in C.
+    if _WORD_TYPECODE is not None:
+        blocks = array(_WORD_TYPECODE, decrypted_data)
+        if byteorder == 'big':
+            blocks.byteswap()
+        calculated_checksum: int = sum(blocks) & 0xFFFFFFFF
+    else:
+        calculated_checksum = sum(block for block, in _BLOCK_STRUCT.iter_unpack(decrypted_data)) \
+            & 0xFFFFFFFF
+
+    result: Dict[str, int] = dict(
+        embedded_checksum=file_checksum, calculated_checksum=calculated_checksum,
+        app_storage_offset=app_storage_offset, data_storage_offset=data_storage_offset,
+        app_size=app_size,
+        data_size=data_size, initial_baud_rate=initial_baud_rate,
+        fast_baud_rate=fast_baud_rate)
+
+    unpacked_information_structure: Optional[Tuple] = None  # Large tuple...
+    try:
+        # Decryption done, now read the information structure inside the image. It's still in
+        # memory, so there's no need to read it back from output.
+        # As far as I can tell, the pointer to the info structure starts at 40.
+        pointer: int = _BLOCK_STRUCT.unpack_from(decrypted_data, 40)[0] - app_storage_offset
+        # unpack_from would count a negative offset from the end.
+        if pointer < 0:
+            raise error('negative info structure pointer')
+        unpacked_information_structure = _INFO_STRUCT.unpack_from(decrypted_data, pointer)
+        result['info_structure_pointer'] = pointer
+    except error:
+        pass
+
+    if unpacked_information_structure is not None:
+        result['magic'] = unpacked_information_structure[0]
+        result['model_name'] = unpacked_information_structure[1].rstrip(
+            b'\x00').decode('ascii')
+        result['hw_version'] = '{}.{}.{}.{}'.format(
+            unpacked_information_structure[2],
+            unpacked_information_structure[3],
+            unpacked_information_structure[4],
+            unpacked_information_structure[5])
+        result['sw_version'] = '{}.{}.{}.{}'.format(
+            unpacked_information_structure[6],
+            unpacked_information_structure[7],
+            unpacked_information_structure[8],
+            unpacked_information_structure[9])
+        result['entrypoint'] = unpacked_information_structure[10]
+        result['app_image_size'] = unpacked_information_structure[11]
+
+    return result
 
 
 def print_firmware_info(file: BinaryIO) -> None:
@@ -94,8 +110,7 @@ def print_firmware_info(file: BinaryIO) -> None:
     Prints out the header of an encrypted image file.
     :param file: the image to analyse.
     """
-    decrypted_firmware = BytesIO()
-    header: Dict[str, int] = decrypt_firmware_image(file, decrypted_firmware)
+    header: Dict[str, int] = decrypt_firmware_image(file)
 
     checksum_matches = 'Checksum ' + 'OK ' if header['calculated_checksum'] == header[
         'embedded_checksum'] else 'wrong'
@@ -2,20 +2,119 @@
 
 """Well, these are unit tests."""
 
+import asyncio
+import json
+import os
+import struct
 import unittest
-from typing import List
+from contextlib import redirect_stdout
+from io import BytesIO, StringIO
+from threading import Event, Timer
+from time import monotonic, sleep
+from typing import Dict, List, Optional
+from unittest.mock import patch
 
+import isdttool
 # noinspection PyProtectedMember
 from isdttool import set_debug
-from .charger.charger import Charger, __generate_raw_frames__, __escape_synchronization__, \
-    __unescape_synchronization__
-from .charger.representation import parse_packet
+from .charger import charger as charger_module
+from .charger.charger import Charger, AsyncCharger, __generate_raw_frames__, \
+    __escape_synchronization__, __unescape_synchronization__
+from .charger.actions import display_metrics, monitor_state
+from .charger.representation import parse_packet, packet_to_str, _METRICS_STRUCT
+from . import firmware
+
+# Every byte value once, including 0xAA, and 0xFF.
+_ALL_BYTES: bytes = bytes(range(256))
+
+# The payloads of firmware update packets captured from the official updater.
+_BLOCK1_PAYLOAD: bytes = (b'\xF4\x00\x00\x40\x00\x08\x90\x1C\x00\x20\x49\x90\x03\x08'
+                          b'\x29\x8E\x03\x08\x2B\x8E\x03\x08\x2D\x8E\x03\x08\x2F\x8E'
+                          b'\x03\x08\x31\x8E\x03\x08\x0C\x8E\x03\x08\x0C\x8E\x03\x08'
+                          b'\x0C\x8E\x03\x08\x0C\x8E\x03\x08\x5B\xCC\x01\x08\x33\x8E'
+                          b'\x03\x08\x00\x00\x00\x00\x15\xCC\x01\x08\x45\x6A\x01\x08'
+                          b'\xDD\x74\x03\x08\xE1\x74\x03\x08\xE5\x74\x03\x08\xE9\x74'
+                          b'\x03\x08\xED\x74\x03\x08\xF1\x74\x03\x08\xF5\x74\x03\x08'
+                          b'\xF9\x74\x03\x08\xFD\x74\x03\x08\x01\x75\x03\x08\x05\x75'
+                          b'\x03\x08\x97\x78\x01\x08\x09\x75\x03\x08\x0D\x75\x03\x08'
+                          b'\x11\x75\x03\x08\x15\x75\x03\x08')
+
+_BLOCK2_PAYLOAD: bytes = (b'\xf4\x00\x80\x42\x00\x08\x00\x7D\xFA\x10\x00\x00\x07\xF7'
+                          b'\x5D\xB0\x00\x00\x0D\x90\x07\xF0\x00\x00\x0F\x70\x08\xD0'
+                          b'\x00\x00\x0C\xA0\x6F\x60\x00\x00\x07\xF9\xF6\x00\x00\x00'
+                          b'\x04\xFF\x40\x00\x06\x70\x1D\xEE\x60\x00\x0E\x90\x7F\x35'
+                          b'\xF3\x00\x6F\x40\xCA\x00\x9E\x30\xDB\x00\xF7\x00\x1C\xFB'
+                          b'\xF3\x00\xBD\x00\x01\xEF\xC1\x00\x5F\xB5\x5B\xF9\xFE\x81'
+                          b'\x05\xBF\xD9\x40\x28\xB0\xFB\xFB\xEB\xB8\xB7\x54\x00\x00'
+                          b'\x00\x10\x00\x99\x02\xF4\x09\xB0\x1F\x60\x5F\x10\x8C\x00'
+                          b'\xBA\x00\xE7\x00\xF7\x00\xF7\x00\xF7\x00\xD7\x00\xBB\x00'
+                          b'\x7D\x00\x4F\x20\x0E\x70\x07\xD0')
+
+# This one contains 0xAA.
+_BLOCK_AA_PAYLOAD: bytes = (b'\xf4\x00\x00\x43\x00\x08\x01\xe5\x00\x77\x01\x00\x00\x3e'
+                            b'\x10\x00\x0b\x80\x00\x05\xf1\x00\x00\xe7\x00\x00\x9b\x00'
+                            b'\x00\x7f\x00\x00\x4f\x40\x00\x1f\x40\x00\x0f\x70\x00\x0f'
+                            b'\x70\x00\x0f\x70\x00\x2f\x40\x00\x4f\x30\x00\x7e\x00\x00'
+                            b'\xaa\x00\x01\xf6\x00\x06\xe0\x00\x0d\x70\x00\x4b\x00\x00'
+                            b'\x00\x4f\x00\x00\x20\x4f\x01\x10\x9f\xcf\xcf\x60\x04\xef'
+                            b'\xc2\x00\x04\xfb\xe2\x00\x0b\x70\x97\x00\x01\x00\x10\x00'
+                            b'\x00\x00\x7f\x00\x00\x00\x00\x7f\x00\x00\x00\x00\x7f\x00'
+                            b'\x00\x00\x00\x7f\x00\x00\x4f\xff\xff\xff\xfb\x14\x44\x9f'
+                            b'\x44\x43\x00\x00\x7f\x00\x00\x00')
+
+
+def metrics_packet(channel: int, mode_id: int = 1) -> bytearray:
+    """The payload of a metrics response of a C4 channel that exists."""
+    return bytearray(b'\xdf' + _METRICS_STRUCT.pack(channel, mode_id, 1, 1, 25, 30, 50, 4100,
+                                                    1000, 80, 4, 1200, 1500, 600))
+
+
+class FakeCharger(Charger):
+    """Answers metrics requests like a C4 with channel_count channels, whose modes can be
+    changed through mode_ids, and logs every write, and read. It notices if a second request is
+    written before the response to the first one is read."""
+
+    def __init__(self, channel_count: int = 256, delay: float = 0.0) -> None:
+        """
+        :param channel_count: Requests for higher channels are answered like a C4 does.
+        :param delay: How long writing a request takes, to give other requests a chance to
+        sneak in.
+        """
+        super().__init__(None, model='C4', mode='app')
+        self.channel_count = channel_count
+        self.delay = delay
+        self.mode_ids: Dict[int, int] = {}
+        self.log: List[str] = []
+        self.pending: List[int] = []
+        self.interleaved = False
+
+    def metrics(self, channel: int) -> None:
+        self.interleaved |= bool(self.pending)
+        self.pending.append(channel)
+        self.log.append(f'w{channel}')
+        if self.delay:
+            sleep(self.delay)
+
+    def read_packet(self, captured_frames: Optional[List[bytearray]] = None) -> bytearray:
+        channel = self.pending.pop(0)
+        self.log.append(f'r{channel}')
+        if channel >= self.channel_count:
+            return bytearray(b'\xdf')
+        return metrics_packet(channel, self.mode_ids.get(channel, 1))
 
 
 class MyTestCase(unittest.TestCase):
+    charger: Charger
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """A charger without a device only reassembles captured frames. It keeps no state
+        between packets, so all tests share one."""
+        cls.charger = Charger(None, model='ignore', mode='ignore')
+
     def setUp(self) -> None:
-        """Enables verbose protocol debugging"""
-        set_debug(True)
+        """Enables verbose protocol debugging if ISDT_TEST_DEBUG is 1."""
+        set_debug(os.environ.get('ISDT_TEST_DEBUG') == '1')
 
     def test_a4_version(self) -> None:
         charger: Charger = Charger(None, model='A4', mode='ignore')
@@ -28,47 +127,53 @@ class MyTestCase(unittest.TestCase):
         self.assertIsNotNone(parse_packet(charger.read_packet(payload), model='ignore'))
 
     def test_real_world_packet(self) -> None:
-        charger: Charger = Charger(None, model='ignore', mode='ignore')
-
-        print('Testing captured frame')
+        """Testing captured frame"""
         payload: List[bytearray] = [
             bytearray(b'\x02 \xaa!\x1a\xdf\x00\x04\x07\x01")d\x00\x00\x00\x009\x00\x00\x00`\x02'
                       b'\xf0\x00\x00\x00\xc0\x01\x00\x00!\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
                       b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
                       b'\x00\x00\x00\x00')]
-        self.assertIsNotNone(charger.read_packet(payload))
+        self.assertIsNotNone(self.charger.read_packet(payload))
 
     def test_protocol_decode_long(self) -> None:
-        charger: Charger = Charger(None, model='ignore', mode='ignore')
-
-        print('Testing long frame')
+        """Testing long frame"""
         payload = bytearray(b'0123456789' * 7)
         original = __generate_raw_frames__(payload=payload)
-        decoded_payload = charger.read_packet(original)
+        decoded_payload = self.charger.read_packet(original)
         self.assertEqual(payload, decoded_payload)
 
     def test_protocol_decode_small(self) -> None:
-        charger: Charger = Charger(None, model='ignore', mode='ignore')
-
-        print('Testing small frame')
+        """Testing small frame"""
         payload = bytearray(b'0123456789')
         original = __generate_raw_frames__(payload=payload)
-        decoded_payload = charger.read_packet(original)
+        decoded_payload = self.charger.read_packet(original)
         self.assertEqual(payload, decoded_payload)
 
+    def test_protocol_decode_split_escape(self) -> None:
+        """Testing escaped synchronization split across two frames"""
+        payload = bytearray(b'0123456789' * 6)
+        payload[58] = 0xAA
+        original = __generate_raw_frames__(payload=payload)
+        self.assertEqual(original[0][-1], 0xAA)
+        self.assertEqual(original[1][2], 0xAA)
+        self.assertEqual(payload, self.charger.read_packet(original))
+
     def test_escaping(self) -> None:
-        print('Testing escaping, and un-escaping the payload')
-        payload = bytearray()
-        for i in range(0, 255):
-            payload.append(i)
+        """Testing escaping, and un-escaping the payload"""
+        payload = bytearray(_ALL_BYTES)
         self.assertEqual(__unescape_synchronization__(__escape_synchronization__(payload)),
                          payload)
 
     def test_broken_sync(self) -> None:
-        print('Testing broken sync')
+        """Testing broken sync"""
         payload = bytearray(b'\x01\x02\xAA\xAA\xAA\x01')
         self.assertEqual(len(__unescape_synchronization__(payload)), 4)
 
+    def test_link_test_failed(self) -> None:
+        text = packet_to_str({'_type': 'link test', '_malformed': False, 'result': False,
+                              'inside boot loader': False}, model='ignore')
+        self.assertEqual(text, 'Link test failed\nCurrently running the app')
+
     # def test_real_life_aa(self) -> None:
     #     payload = bytearray(b'\x21\x1a\xdf\x01\x0b\x05\x01\x22\x2b\x63\x76\x07\x97\x02'
     #                         b'\x1e\x00\xf2\x04\xba\x07\xaa\xaa\x02\x00\x00\x79\x08\x00'
@@ -77,7 +182,7 @@ class MyTestCase(unittest.TestCase):
     #     __unescape_synchronization__(payload)
 
     def test_write_block1(self) -> None:
-        print('Testing larger packet captured from the official firmware updater')
+        """Testing larger packet captured from the official firmware updater"""
         capture: List[bytearray] = [
             bytearray(b'\x01\x3E\xAA\x12\x86\xF4\x00\x00\x40\x00\x08\x90\x1C\x00\x20\x49\x90\x03'
                       b'\x08\x29\x8E\x03\x08\x2B\x8E\x03\x08\x2D\x8E\x03\x08\x2F\x8E\x03\x08\x31'
@@ -89,24 +194,12 @@ class MyTestCase(unittest.TestCase):
                       b'\x75\x03\x08\x97\x78\x01\x08\x09\x75\x03'),
             bytearray(b'\x01\x0E\x08\x0D\x75\x03\x08\x11\x75\x03\x08\x15\x75\x03\x08\xBA')]
 
-        charger: Charger = Charger(None, model='ignore', mode='ignore')
-        read_payload = charger.read_packet(capture)
+        read_payload = self.charger.read_packet(capture)
         self.assertEqual(len(read_payload), 0x86)
-        self.assertEqual(read_payload,
-                         bytearray(b'\xF4\x00\x00\x40\x00\x08\x90\x1C\x00\x20\x49\x90\x03\x08'
-                                   b'\x29\x8E\x03\x08\x2B\x8E\x03\x08\x2D\x8E\x03\x08\x2F\x8E'
-                                   b'\x03\x08\x31\x8E\x03\x08\x0C\x8E\x03\x08\x0C\x8E\x03\x08'
-                                   b'\x0C\x8E\x03\x08\x0C\x8E\x03\x08\x5B\xCC\x01\x08\x33\x8E'
-                                   b'\x03\x08\x00\x00\x00\x00\x15\xCC\x01\x08\x45\x6A\x01\x08'
-                                   b'\xDD\x74\x03\x08\xE1\x74\x03\x08\xE5\x74\x03\x08\xE9\x74'
-                                   b'\x03\x08\xED\x74\x03\x08\xF1\x74\x03\x08\xF5\x74\x03\x08'
-                                   b'\xF9\x74\x03\x08\xFD\x74\x03\x08\x01\x75\x03\x08\x05\x75'
-                                   b'\x03\x08\x97\x78\x01\x08\x09\x75\x03\x08\x0D\x75\x03\x08'
-                                   b'\x11\x75\x03\x08\x15\x75\x03\x08'))
+        self.assertEqual(read_payload, _BLOCK1_PAYLOAD)
 
     def test_write_block2(self) -> None:
-        print('Testing larger packet captured from the official firmware updater 2')
-        charger: Charger = Charger(None, model='ignore', mode='ignore')
+        """Testing larger packet captured from the official firmware updater 2"""
         capture: List[bytearray] = [
             bytearray(b'\x01\x3e\xaa\x12\x86\xf4\x00\x80\x42\x00\x08\x00\x7d\xfa\x10\x00\x00\x07'
                       b'\xf7\x5d\xb0\x00\x00\x0d\x90\x07\xf0\x00\x00\x0f\x70\x08\xd0\x00\x00\x0c'
@@ -118,22 +211,11 @@ class MyTestCase(unittest.TestCase):
                       b'\x00\xba\x00\xe7\x00\xf7\x00\xf7\x00\xf7'),
             bytearray(b'\x01\x0e\x00\xd7\x00\xbb\x00\x7d\x00\x4f\x20\x0e\x70\x07\xd0\xa9')]
 
-        read_payload = charger.read_packet(capture)
-        self.assertEqual(read_payload,
-                         bytearray(b'\xf4\x00\x80\x42\x00\x08\x00\x7D\xFA\x10\x00\x00\x07\xF7'
-                                   b'\x5D\xB0\x00\x00\x0D\x90\x07\xF0\x00\x00\x0F\x70\x08\xD0'
-                                   b'\x00\x00\x0C\xA0\x6F\x60\x00\x00\x07\xF9\xF6\x00\x00\x00'
-                                   b'\x04\xFF\x40\x00\x06\x70\x1D\xEE\x60\x00\x0E\x90\x7F\x35'
-                                   b'\xF3\x00\x6F\x40\xCA\x00\x9E\x30\xDB\x00\xF7\x00\x1C\xFB'
-                                   b'\xF3\x00\xBD\x00\x01\xEF\xC1\x00\x5F\xB5\x5B\xF9\xFE\x81'
-                                   b'\x05\xBF\xD9\x40\x28\xB0\xFB\xFB\xEB\xB8\xB7\x54\x00\x00'
-                                   b'\x00\x10\x00\x99\x02\xF4\x09\xB0\x1F\x60\x5F\x10\x8C\x00'
-                                   b'\xBA\x00\xE7\x00\xF7\x00\xF7\x00\xF7\x00\xD7\x00\xBB\x00'
-                                   b'\x7D\x00\x4F\x20\x0E\x70\x07\xD0'))
+        read_payload = self.charger.read_packet(capture)
+        self.assertEqual(read_payload, _BLOCK2_PAYLOAD)
 
     def test_write_block_aa(self) -> None:
-        print('Testing large packet captured with 0xAA in payload.')
-        charger: Charger = Charger(None, model='ignore', mode='ignore')
+        """Testing large packet captured with 0xAA in payload."""
         capture: List[bytearray] = [
             bytearray(b'\x01\x3e\xaa\x12\x86\xf4\x00\x00\x43\x00\x08\x01\xe5\x00\x77\x01\x00\x00'
                       b'\x3e\x10\x00\x0b\x80\x00\x05\xf1\x00\x00\xe7\x00\x00\x9b\x00\x00\x7f\x00'
@@ -145,36 +227,15 @@ class MyTestCase(unittest.TestCase):
                       b'\x7f\x00\x00\x00\x00\x7f\x00\x00\x4f\xff'),
             bytearray(b'\x01\x0f\xff\xff\xfb\x14\x44\x9f\x44\x43\x00\x00\x7f\x00\x00\x00\x90')]
 
-        read_payload = charger.read_packet(capture)
-        self.assertEqual(read_payload,
-                         bytearray(b'\xf4\x00\x00\x43\x00\x08\x01\xe5\x00\x77\x01\x00\x00\x3e'
-                                   b'\x10\x00\x0b\x80\x00\x05\xf1\x00\x00\xe7\x00\x00\x9b\x00'
-                                   b'\x00\x7f\x00\x00\x4f\x40\x00\x1f\x40\x00\x0f\x70\x00\x0f'
-                                   b'\x70\x00\x0f\x70\x00\x2f\x40\x00\x4f\x30\x00\x7e\x00\x00'
-                                   b'\xaa\x00\x01\xf6\x00\x06\xe0\x00\x0d\x70\x00\x4b\x00\x00'
-                                   b'\x00\x4f\x00\x00\x20\x4f\x01\x10\x9f\xcf\xcf\x60\x04\xef'
-                                   b'\xc2\x00\x04\xfb\xe2\x00\x0b\x70\x97\x00\x01\x00\x10\x00'
-                                   b'\x00\x00\x7f\x00\x00\x00\x00\x7f\x00\x00\x00\x00\x7f\x00'
-                                   b'\x00\x00\x00\x7f\x00\x00\x4f\xff\xff\xff\xfb\x14\x44\x9f'
-                                   b'\x44\x43\x00\x00\x7f\x00\x00\x00'))
+        read_payload = self.charger.read_packet(capture)
+        self.assertEqual(read_payload, _BLOCK_AA_PAYLOAD)
 
     def test_large_packet_for_firmware_writing(self) -> None:
-        print('Test the creation of real world update packets')
-        payload_in: bytearray = bytearray(b'\xf4\x00\x00\x43\x00\x08\x01\xe5\x00\x77\x01\x00\x00'
-                                          b'\x3e\x10\x00\x0b\x80\x00\x05\xf1\x00\x00\xe7\x00\x00'
-                                          b'\x9b\x00\x00\x7f\x00\x00\x4f\x40\x00\x1f\x40\x00\x0f'
-                                          b'\x70\x00\x0f\x70\x00\x0f\x70\x00\x2f\x40\x00\x4f\x30'
-                                          b'\x00\x7e\x00\x00\xaa\x00\x01\xf6\x00\x06\xe0\x00\x0d'
-                                          b'\x70\x00\x4b\x00\x00\x00\x4f\x00\x00\x20\x4f\x01\x10'
-                                          b'\x9f\xcf\xcf\x60\x04\xef\xc2\x00\x04\xfb\xe2\x00\x0b'
-                                          b'\x70\x97\x00\x01\x00\x10\x00\x00\x00\x7f\x00\x00\x00'
-                                          b'\x00\x7f\x00\x00\x00\x00\x7f\x00\x00\x00\x00\x7f\x00'
-                                          b'\x00\x4f\xff\xff\xff\xfb\x14\x44\x9f\x44\x43\x00\x00'
-                                          b'\x7f\x00\x00\x00')
+        """Test the creation of real world update packets"""
+        payload_in: bytearray = bytearray(_BLOCK_AA_PAYLOAD)
 
         generated_frames = __generate_raw_frames__(payload_in)
-        charger: Charger = Charger(None, model='ignore', mode='ignore')
-        payload_out = charger.read_packet(generated_frames.copy())
+        payload_out = self.charger.read_packet(generated_frames.copy())
 
         self.assertEqual(payload_in, payload_out)
         self.assertEqual(generated_frames,
@@ -191,6 +252,148 @@ class MyTestCase(unittest.TestCase):
                           bytearray(b'\x01\x0f\xff\xff\xfb\x14\x44\x9f\x44\x43\x00\x00\x7f\x00\x00'
                                     b'\x00\x90')])
 
+    def test_async_requests_serialized(self) -> None:
+        """Concurrent requests to one charger must not interleave"""
+        charger = FakeCharger(delay=0.01)
+        async_charger = AsyncCharger(charger)
+
+        async def request_all() -> List[bytearray]:
+            return await asyncio.gather(*(async_charger.metrics(i) for i in range(4)))
+
+        results = asyncio.run(request_all())
+
+        self.assertFalse(charger.interleaved)
+        self.assertEqual(results, [metrics_packet(i) for i in range(4)])
+
+    def test_async_request_cancelled(self) -> None:
+        """A cancelled request must still finish before the next one starts"""
+        charger = FakeCharger(delay=0.01)
+        async_charger = AsyncCharger(charger)
+
+        async def cancel_first() -> bytearray:
+            first = asyncio.ensure_future(async_charger.metrics(0))
+            await asyncio.sleep(0.001)  # Lets the first request reach the charger.
+            first.cancel()
+            second = await async_charger.metrics(1)
+            self.assertTrue(first.cancelled())
+            return second
+
+        self.assertEqual(asyncio.run(cancel_first()), metrics_packet(1))
+        self.assertFalse(charger.interleaved)
+        # The lock of the first loop must not be reused.
+        self.assertEqual(asyncio.run(async_charger.metrics(2)), metrics_packet(2))
+
+    def test_display_metrics_pipelined(self) -> None:
+        """The next request is written before the current response is read, the output must not
+        change because of that"""
+        for channels, order in (([], []),
+                                ([0], ['w0', 'r0']),
+                                ([0, 1, 2], ['w0', 'w1', 'r0', 'w2', 'r1', 'r2'])):
+            charger = FakeCharger()
+            output = StringIO()
+            with redirect_stdout(output):
+                display_metrics(charger, 0, 2, channels, 'json')
+
+            self.assertEqual(charger.log, order * 2)
+            self.assertEqual(json.loads(output.getvalue()),
+                             [{**parse_packet(metrics_packet(c), 'C4'), '_measurement': step}
+                              for step in (1, 2) for c in channels])
+
+    def test_monitor_state_batches(self) -> None:
+        """Channels are discovered, and polled in batches, so the channel counts around the batch
+        size are interesting"""
+        class Done(Exception):
+            """Stops monitor_state, which never returns if there are channels."""
+
+        for channel_count in (0, 3, 4, 5, 8):
+            charger = FakeCharger(channel_count)
+            events: List[tuple] = []
+
+            def func(last: Optional[dict], current: dict) -> None:
+                # monitor_state keeps modifying its dicts, so only copies are kept.
+                events.append((last and dict(last), dict(current)))
+                if current['_reason'] == 'channel id':
+                    charger.mode_ids[current['_channel']] = 2  # Changes the first poll.
+                if len(events) == 3 * channel_count:  # Enough for the events expected below.
+                    raise Done()
+
+            if channel_count == 0:
+                monitor_state(charger, func, 0, 2)
+            else:
+                self.assertRaises(Done, monitor_state, charger, func, 0, 2)
+
+            idle = [parse_packet(metrics_packet(c), 'C4') for c in range(channel_count)]
+            changed = [parse_packet(metrics_packet(c, 2), 'C4') for c in range(channel_count)]
+            if channel_count == 0:
+                expected: List[tuple] = [(None, {'_reason': 'no channels'})]
+            else:
+                expected = \
+                    [(None, {'_reason': 'channel id', '_channel': c, **idle[c]})
+                     for c in range(channel_count)] + \
+                    [(idle[c], {**changed[c], '_iteration': 1, '_reason': 'mode id'})
+                     for c in range(channel_count)] + \
+                    [(None, {**changed[c], '_reason': 'periodic'}) for c in range(channel_count)]
+            self.assertEqual(events, expected)
+            for _, current in events[:channel_count]:
+                self.assertEqual(list(current)[:2], ['_reason', '_channel'])
+
+            # The responses of a batch have to fit into the input report queue.
+            outstanding = [0]
+            for entry in charger.log:
+                outstanding.append(outstanding[-1] + (1 if entry[0] == 'w' else -1))
+            self.assertLessEqual(max(outstanding), 4)
+
+    def test_monitor_state_wakeup(self) -> None:
+        """Setting wakeup must cut the interval short, whether it's set while waiting, or while
+        polling"""
+        class Done(Exception):
+            """Stops monitor_state, which never returns if there are channels."""
+
+        wakeup = Event()
+        polls: List[float] = []
+
+        def func(_: Optional[dict], current: dict) -> None:
+            if current['_reason'] != 'periodic':
+                return
+            polls.append(monotonic())
+            if len(polls) == 2:
+                wakeup.set()  # While polling, as if it arrived right after the event was cleared.
+            elif len(polls) == 3:
+                raise Done()
+
+        timer = Timer(0.05, wakeup.set)  # Another thread, while monitor_state waits.
+        timer.start()
+        start = monotonic()
+        self.assertRaises(Done, monitor_state, FakeCharger(1), func, 5, 1, wakeup)
+        timer.cancel()
+
+        self.assertEqual(len(polls), 3)
+        self.assertLess(polls[-1] - start, 4)
+        self.assertFalse(wakeup.is_set())
+
+    def test_firmware_checksum(self) -> None:
+        """The checksum must be the sum of the little endian blocks, however they are summed"""
+        key1, key2 = 0x12345678, 0x9abcdef0
+        plain = bytes(range(64))  # Sums up to 0x1201f1e0 as little endian blocks.
+        image = bytearray(struct.pack('<8I', key1, key2, 0x08004000, 0, len(plain), 0, 0, 0))
+        for block, in struct.iter_unpack('<I', plain):
+            image += struct.pack('<I', block ^ key2)
+            key2 = ((key2 + key1) & 0xFFFFFFFF) ^ key1
+
+        for typecode in (firmware._WORD_TYPECODE, None):
+            with patch.object(firmware, '_WORD_TYPECODE', typecode):
+                output = BytesIO()
+                result = firmware.decrypt_firmware_image(BytesIO(image), output)
+                self.assertEqual(output.getvalue(), plain)
+                self.assertEqual(result['calculated_checksum'], 0x1201f1e0)
+
+    def test_debug_mode_alias(self) -> None:
+        """isdttool.DEBUG_MODE still switches the debug mode of the charger module"""
+        isdttool.DEBUG_MODE = True
+        self.assertTrue(charger_module.DEBUG_MODE)
+        set_debug(False)
+        self.assertFalse(isdttool.DEBUG_MODE)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -21,7 +21,7 @@ setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     entry_points={'console_scripts': ['isdttool=isdttool.cli_tool:main']},
-    python_requires='>=3.6',
+    python_requires='>=3.8',
     classifiers=[
         "Programming Language :: Python :: 3",
         "System :: Hardware :: Hardware Drivers",